@@ -1,19 +1,177 @@
 """
 Ergast API tools. https://ergast.gom/api/
 """
+import asyncio
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
 from itertools import chain
-from json import dump, load, loads
+from json import dump, dumps, load, loads
+from math import inf
 from operator import itemgetter
+from os import replace
 from pathlib import Path
-from sys import stderr as STDERR
-from time import sleep
-from urllib.request import urlopen
+from sqlite3 import connect
+from sys import intern, stderr as STDERR
+from threading import Lock, local
+from time import gmtime, monotonic, sleep, time
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+from weakref import WeakKeyDictionary
+from zlib import compress, decompress
 
 BASE = "https://ergast.com/api"
+EXPIRES = 6 * 60 * 60
+LEVEL = 6
 LIMIT = 100
+RATE = 4
 RETRIES = 2
+SQLITE = (".db", ".sqlite", ".sqlite3")
+TABLES = {
+    "circuits": (
+        "CircuitTable Circuits Circuit",
+        "circuitId circuitName country lat long locality url",
+    ),
+    "constructors": (
+        "ConstructorTable Constructors Constructor",
+        "constructorId name nationality url",
+    ),
+    "drivers": (
+        "DriverTable Drivers Driver",
+        "driverId code dateOfBirth familyName givenName nationality"
+        " permanentNumber url",
+    ),
+    "seasons": ("SeasonTable Seasons Season", "season url"),
+    "status": ("StatusTable Status Status", "statusId count status"),
+}
 TIMEOUT = 8
+TYPES = {
+    "count": int,
+    "grid": int,
+    "lap": int,
+    "laps": int,
+    "lat": float,
+    "long": float,
+    "millis": int,
+    "number": int,
+    "permanentNumber": int,
+    "points": float,
+    "position": int,
+    "rank": int,
+    "round": int,
+    "season": int,
+    "speed": float,
+    "statusId": int,
+    "stop": int,
+    "wins": int,
+}
+WORKERS = 1
+
+
+def flattened(item, row=None, name=None):
+    """ Iterator[tuple]: Names and dicts of innermost rows. Rows inherit fields. """
+    leaf, lists, row = row is not None, [], dict(row or {})
+
+    pending = [("", item)]
+    while pending:
+        prefix, item = pending.pop()
+        for key, value in item.items():
+            if isinstance(value, dict):
+                pending.append((f"{prefix}{key}_", value))
+            elif isinstance(value, list) and all(isinstance(x, dict) for x in value):
+                lists.append((key, value))
+            else:
+                row[prefix + key] = value
+
+    if leaf and not lists:
+        yield name, row
+    for key, items in lists:
+        for x in items:
+            yield from flattened(x, row, key)
+
+
+def migrate(source, target):
+    """ int: Copy every cached query from one store to another. """
+    count = 0
+    for args in source.queries():
+        target.save(args, source.load(args))
+        count += 1
+
+    return count
+
+
+def seasonal(args, expires=EXPIRES):
+    """ float: Seconds until cached pages expire. Past seasons never expire. """
+    season = str(args[1]) if len(args) > 1 else ""
+    if season.isdigit() and int(season) < gmtime().tm_year:
+        return inf
+
+    return expires
+
+
+@lru_cache(maxsize=None)
+def recorded(name, cols):
+    """ type: Record class with one slot per column. """
+    return type(name, (Record,), {"__slots__": cols})
+
+
+async def responded(reader):
+    """ tuple: Status, reason, body and keep-alive flag of an HTTP/1.1 reply. """
+    line = await reader.readline()
+    if not line:
+        raise ConnectionResetError("Remote end closed connection without response")
+    _, status, *reason = line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, value = line.decode("latin-1").split(":", 1)
+        headers[key.strip().lower()] = value.strip()
+
+    keep = headers.get("connection", "").lower() != "close"
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        body = bytearray()
+        size = int((await reader.readline()).split(b";")[0], 16)
+        while size:
+            body += await reader.readexactly(size + 2)
+            del body[-2:]
+            size = int((await reader.readline()).split(b";")[0], 16)
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        body = bytes(body)
+    elif "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+    else:
+        body, keep = await reader.read(), False
+
+    return int(status), "".join(reason), body, keep
+
+
+def stored(folder):
+    """ FolderStore, SQLiteStore or None: Cache store for a path or store. """
+    if not folder:
+        return None
+    elif hasattr(folder, "load"):
+        return folder
+    elif Path(folder).suffix in SQLITE:
+        return SQLiteStore(folder)
+    else:
+        return FolderStore(folder)
+
+
+def tabulated(table, pages):
+    """ List[namedtuple]: Rows of a pre-formatted f1 table from its pages. """
+    keys, cols = TABLES[table]
+    *keys, name = keys.split()
+    rows = unpacked(pages, "MRData", *keys)
+    if table == "circuits":
+        rows = ({**x.pop("Location"), **x} for x in rows)
+    rows = tupled(rows, name, *cols.split())
+
+    return list(rows)
 
 
 def tupled(rows, name, *cols):
@@ -23,6 +181,20 @@ def tupled(rows, name, *cols):
     return (Row(**x) for x in rows)
 
 
+def typed(key, value):
+    """ int, float, str or None: Value converted to its column type. """
+    kind = TYPES.get(key.rsplit("_", 1)[-1])
+    if value is None:
+        return None
+    elif kind:
+        try:
+            return kind(value)
+        except (TypeError, ValueError):
+            return None
+
+    return intern(value) if isinstance(value, str) else value
+
+
 def unpacked(rows, *keys):
     """ Iterator[dict]: Dictionaries extracted from query replies. """
     for key in keys:
@@ -47,15 +219,38 @@ class ErgastAPI:
 
     For bigger queries, download a database image: https://ergast.com/mrd/db/
 
+    Reuses one keep-alive connection per thread instead of reconnecting.
+    Set workers > 1 to fetch pages in parallel after the first page.
+    Worker threads (and their connections) are kept between queries.
+    All threads share one rate limit, so the server sees at most
+    rate requests per second no matter how many workers there are.
+
+    A folder caches one JSON file per page. A path ending in .db, .sqlite or
+    .sqlite3 caches every page in one SQLite file instead. Any object with
+    the same methods as FolderStore can also be used as a cache store.
+
+    Cached pages expire after expires(query) seconds. The default expires
+    queries for past seasons never and everything else after 6 hours.
+    An expired query only refetches its last cached page and any new pages.
+    If the server cannot be reached, expired pages are served as they are.
+
     Inputs
-        folder      Path, str or None: Cache folder. Input None to disable cache.
+        folder      Path, str, store or None: Cache. Input None to disable cache.
         limit       int: Maximum results per page.
         retries     int: Maximum retries per query.
         timeout     float: Max seconds to wait for each response.
+        workers     int: Maximum pages to fetch at once.
+        rate        float: Maximum requests per second. Input 0 for no limit.
+        base        str: Base URL for queries.
+        expires     callable, float or None: Seconds until cached pages expire.
+                    Input None to keep cached pages forever.
 
     Create an ErgastAPI which caches replies to local disk.
     >>> api = ErgastAPI('path/to/cache/folder')
 
+    Cache replies in a single SQLite file.
+    >>> api = ErgastAPI('path/to/cache.sqlite')
+
     Call with query parameters to generate paged replies.
     >>> pages = [ x for x in api('f1', 1990, 6, 'pitstops') ]
 
@@ -70,19 +265,38 @@ class ErgastAPI:
     >>> api.f1status
     """
 
-    def __init__(self, folder=None, limit=LIMIT, retries=RETRIES, timeout=TIMEOUT):
-        self.folder = Path(folder) if folder else None
+    def __init__(
+        self,
+        folder=None,
+        limit=LIMIT,
+        retries=RETRIES,
+        timeout=TIMEOUT,
+        workers=WORKERS,
+        rate=RATE,
+        base=BASE,
+        expires=seasonal,
+    ):
+        self.store = stored(folder)
         self.limit = int(limit)
         self.retries = int(retries)
         self.timeout = float(timeout)
+        self.workers = int(workers)
+        self.rate = float(rate)
+        self.base = str(base).rstrip("/")
+        self.expires = expires
+        self._lock = Lock()
+        self._local = local()
+        self._next = 0.0
+        self._pool = None
 
     def __call__(self, *args):
         """ Iterator[dict]: Paginated replies. Set folder=None to disable cache. """
-        return self.cached(*args) if self.folder else self.batches(*args)
+        return self.cached(*args) if self.store else self.batches(*args)
 
     def __repr__(self):
         name = type(self).__name__
-        params = ", ".join(f"{k}={v}" for k, v in vars(self).items())
+        params = vars(self).items()
+        params = ", ".join(f"{k}={v}" for k, v in params if not k.startswith("_"))
 
         return f"{name}({params})"
 
@@ -91,128 +305,192 @@ class ErgastAPI:
     @property
     def f1circuits(self):
         """ List[namedtuple]: All tracks. """
-        rows = self("f1", "circuits")
-        keys = "MRData CircuitTable Circuits".split()
-        cols = "circuitId circuitName country lat long locality url".split()
-        rows = unpacked(rows, *keys)
-        rows = ({**x, **x.pop("Location")} for x in rows)
-        rows = tupled(rows, "Circuit", *cols)
-
-        return list(rows)
+        return tabulated("circuits", self("f1", "circuits"))
 
     @property
     def f1constructors(self):
         """ List[namedtuple]: All constructors. """
-        rows = self("f1", "constructors")
-        keys = "MRData ConstructorTable Constructors".split()
-        cols = "constructorId name nationality url".split()
-        rows = unpacked(rows, *keys)
-        rows = tupled(rows, "Constructor", *cols)
-
-        return list(rows)
+        return tabulated("constructors", self("f1", "constructors"))
 
     @property
     def f1drivers(self):
         """ List[namedtuple]: All drivers. """
-        rows = self("f1", "drivers")
-        keys = "MRData DriverTable Drivers".split()
-        cols = "driverId code dateOfBirth familyName givenName nationality".split()
-        cols += "permanentNumber url".split()
-        rows = unpacked(rows, *keys)
-        rows = tupled(rows, "Driver", *cols)
-
-        return list(rows)
+        return tabulated("drivers", self("f1", "drivers"))
 
     @property
     def f1seasons(self):
         """ List[namedtuple]: All seasons. """
-        rows = self("f1", "seasons")
-        keys = "MRData SeasonTable Seasons".split()
-        cols = "season url".split()
-        rows = unpacked(rows, *keys)
-        rows = tupled(rows, "Season", *cols)
-
-        return list(rows)
+        return tabulated("seasons", self("f1", "seasons"))
 
     @property
     def f1status(self):
         """ List[namedtuple]: Status codes for race results. """
-        rows = self("f1", "status")
-        keys = "MRData StatusTable Status".split()
-        cols = "statusId count status".split()
-        rows = unpacked(rows, *keys)
-        rows = tupled(rows, "Status", *cols)
-
-        return list(rows)
+        return tabulated("status", self("f1", "status"))
 
     # Manual query methods
 
-    def batches(self, *args):
+    def batches(self, *args, offset=0):
         """ Iterator[dict]: Replies with automatic pagination. """
-        limit, reply = self.limit, self.reply
+        limit, reply, workers = self.limit, self.reply, self.workers
 
-        offset, total = 0, 1
-        while offset < total:
-            page = reply(*args, offset=offset)
-            total = int(page["MRData"]["total"])
-            offset += limit
-            yield page
+        page = reply(*args, offset=offset)
+        total = int(page["MRData"]["total"])
+        yield page
+
+        offsets = range(offset + limit, total, limit)
+        if workers > 1:
+            submit = self.pool.submit
+            futures = [submit(reply, *args, offset=x) for x in offsets]
+            try:
+                for future in futures:
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+        else:
+            yield from (reply(*args, offset=x) for x in offsets)
 
     def cached(self, *args):
-        """ Iterator[dict]: Cached pages. Downloads pages if none exist. """
-        download, querypath = self.download, self.querypath
+        """
+        Iterator[dict]: Cached pages. Downloads missing or expired pages.
+        Serves expired pages anyway if they cannot be revalidated.
+        """
+        download, expired, revalidate = self.download, self.expired, self.revalidate
+        store = self.store
 
-        folder = querypath(*args)
-        if not any(folder.glob("*.json")):
+        if not store.exists(args):
             download(*args)
+        elif expired(args):
+            try:
+                revalidate(*args)
+            except Exception as err:
+                warn(f"Serve expired cache because {err}")
 
-        for path in sorted(folder.glob("*.json")):
-            with open(path) as file:
-                yield load(file)
+        yield from store.load(args)
 
     def download(self, *args):
-        """ None: Delete any old pages. Get and save new pages. """
-        batches, erase, querypath = self.batches, self.erase, self.querypath
+        """ None: Get new pages. Replace any old pages. """
+        batches, store = self.batches, self.store
 
-        folder = querypath(*args)
-        if folder.exists():
-            erase(*args)
-        else:
-            print(f"mkdir {folder}")
-            folder.mkdir(parents=True)
-
-        for i, data in enumerate(batches(*args)):
-            path = (folder / str(i)).with_suffix(".json")
-            with open(path, "w") as file:
-                print(f"save {path}")
-                dump(data, file, allow_nan=False, indent=2)
+        store.save(args, batches(*args))
 
     def erase(self, *args):
         """ None: Delete any cached pages. """
-        querypath = self.querypath
+        self.store.erase(args)
 
-        for path in querypath(*args).glob("*.json"):
-            print(f"rm {path}")
-            path.unlink()
+    def expired(self, args):
+        """ bool: True if cached pages are older than the expiry policy allows. """
+        expires, store = self.expires, self.store
+
+        if expires is None:
+            return False
+
+        seconds = expires(args) if callable(expires) else float(expires)
+        return time() - (store.fetched(args) or 0) > seconds
+
+    def frame(self, *args):
+        """ DataFrame: Typed rows of a query. Needs numpy and pandas. """
+        columns, records = None, Records()
+
+        for page in self(*args):
+            if columns is None:
+                columns = Columns(page["MRData"]["total"])
+            for record in records(page):
+                columns.append(record)
+
+        return columns.frame()
+
+    def revalidate(self, *args):
+        """ None: Refetch the last cached page and any pages after it. """
+        batches, store = self.batches, self.store
+
+        count, page = store.tail(args)
+        offset = int(page["MRData"]["offset"])
+        store.save(args, batches(*args, offset=offset), start=count - 1)
+
+    def rows(self, *args):
+        """ Iterator[Record]: Typed rows of a query, one page in memory at a time. """
+        records = Records()
+
+        for page in self(*args):
+            yield from records(page)
 
     # Helpers
 
-    def querypath(self, *args):
-        """ Path: Path to cache folder. """
-        return self.folder.joinpath(*map(str, args))
+    def fetch(self, url, timeout=TIMEOUT):
+        """
+        bytes: Response body. Reuses this thread's connection if possible.
+        Resends right away, once, if the server closed a reused connection.
+        """
+        pace, thread = self.pace, self._local
+
+        scheme, netloc, path, query, _ = urlsplit(url)
+        conn = getattr(thread, "conn", None)
+        if (conn is None) or (thread.netloc != (scheme, netloc)):
+            Connection = HTTPSConnection if (scheme == "https") else HTTPConnection
+            conn = thread.conn = Connection(netloc, timeout=timeout)
+            thread.netloc = (scheme, netloc)
+
+        path = f"{path}?{query}" if query else path
+        reused = conn.sock is not None
+
+        pace()
+        try:
+            conn.timeout = timeout
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+            try:
+                conn.request("GET", path)
+                response = conn.getresponse()
+            except (BrokenPipeError, ConnectionResetError):
+                if not reused:
+                    raise
+                conn.close()
+                conn.request("GET", path)
+                response = conn.getresponse()
+            with response:
+                body = response.read()
+                if response.status != 200:
+                    raise HTTPException(f"{response.status} {response.reason}")
+        except Exception:
+            conn.close()
+            thread.conn = None
+            raise
+
+        return body
+
+    def pace(self):
+        """ None: Wait until the rate limit allows another request. """
+        lock, rate = self._lock, self.rate
+
+        if rate > 0:
+            with lock:
+                now = monotonic()
+                start = max(now, self._next)
+                self._next = start + 1 / rate
+            sleep(start - now)
+
+    @property
+    def pool(self):
+        """ ThreadPoolExecutor: Worker threads shared by every query. """
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.workers)
+
+        return self._pool
 
     def reply(self, *args, offset=0):
         """ dict: Data extracted from query reply. """
+        base, fetch = self.base, self.fetch
         limit, retries, timeout = self.limit, self.retries, self.timeout
 
         path = "/".join(map(str, args)) + ".json"
-        url = f"{BASE}/{path}?limit={limit}&offset={offset}"
+        url = f"{base}/{path}?limit={limit}&offset={offset}"
         print(f"GET {url}")
 
         for itry in reversed(range(1 + retries)):
             try:
-                with urlopen(url, timeout=timeout) as file:
-                    return loads(file.read())
+                return loads(fetch(url, timeout=timeout))
 
             except Exception as err:
                 if itry:
@@ -224,6 +502,606 @@ class ErgastAPI:
                     raise err
 
 
+class AsyncErgastAPI(ErgastAPI):
+    """
+    Get data from https://ergast.com/api/ politely without blocking asyncio.
+
+    Same inputs and query surface as ErgastAPI, but every query is a coroutine
+    or an async iterator. Requests use asyncio streams, so no threads are used
+    for network I/O. The cache store is read and written in the default executor.
+
+    One semaphore per event loop caps requests in flight at workers,
+    shared by every query running on that loop. Retries wait with
+    asyncio.sleep so other queries keep going during backoff.
+
+    Call with query parameters to generate paged replies.
+    >>> api = AsyncErgastAPI('path/to/cache/folder', workers=4)
+    >>> pages = [x async for x in api('f1', 1990, 6, 'pitstops')]
+
+    Run many queries at once.
+    >>> seasons = await asyncio.gather(*(api.collect('f1', x) for x in years))
+
+    Erase cached results (if any) for a specific query.
+    >>> await api.erase('f1', 1990, 6, 'pitstops')
+
+    Pre-formatted queries return awaitables of lists of namedtuples:
+    >>> await api.f1circuits
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loops = WeakKeyDictionary()
+
+    # Tables
+
+    @property
+    def f1circuits(self):
+        """ Awaitable[List[namedtuple]]: All tracks. """
+        return self.tabled("circuits")
+
+    @property
+    def f1constructors(self):
+        """ Awaitable[List[namedtuple]]: All constructors. """
+        return self.tabled("constructors")
+
+    @property
+    def f1drivers(self):
+        """ Awaitable[List[namedtuple]]: All drivers. """
+        return self.tabled("drivers")
+
+    @property
+    def f1seasons(self):
+        """ Awaitable[List[namedtuple]]: All seasons. """
+        return self.tabled("seasons")
+
+    @property
+    def f1status(self):
+        """ Awaitable[List[namedtuple]]: Status codes for race results. """
+        return self.tabled("status")
+
+    # Manual query methods
+
+    async def batches(self, *args, offset=0):
+        """ AsyncIterator[dict]: Replies with automatic pagination. """
+        limit, reply = self.limit, self.reply
+
+        page = await reply(*args, offset=offset)
+        total = int(page["MRData"]["total"])
+        yield page
+
+        offsets = range(offset + limit, total, limit)
+        tasks = [asyncio.ensure_future(reply(*args, offset=x)) for x in offsets]
+        try:
+            for task in tasks:
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def cached(self, *args):
+        """
+        AsyncIterator[dict]: Cached pages. Downloads missing or expired pages.
+        Serves expired pages anyway if they cannot be revalidated.
+        """
+        download, expired, revalidate = self.download, self.expired, self.revalidate
+        loop, store = asyncio.get_running_loop(), self.store
+
+        if not await loop.run_in_executor(None, store.exists, args):
+            await download(*args)
+        elif await loop.run_in_executor(None, expired, args):
+            try:
+                await revalidate(*args)
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                warn(f"Serve expired cache because {err}")
+
+        pages = await loop.run_in_executor(None, store.load, args)
+        page = await loop.run_in_executor(None, next, pages, None)
+        while page is not None:
+            yield page
+            page = await loop.run_in_executor(None, next, pages, None)
+
+    async def collect(self, *args):
+        """ List[dict]: All pages of a query. """
+        return [x async for x in self(*args)]
+
+    async def download(self, *args):
+        """ None: Get new pages. Replace any old pages. """
+        batches, store = self.batches, self.store
+        loop = asyncio.get_running_loop()
+
+        pages = [x async for x in batches(*args)]
+        await loop.run_in_executor(None, store.save, args, pages)
+
+    async def erase(self, *args):
+        """ None: Delete any cached pages. """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.store.erase, args)
+
+    async def frame(self, *args):
+        """ DataFrame: Typed rows of a query. Needs numpy and pandas. """
+        columns, records = None, Records()
+
+        async for page in self(*args):
+            if columns is None:
+                columns = Columns(page["MRData"]["total"])
+            for record in records(page):
+                columns.append(record)
+
+        return columns.frame()
+
+    async def revalidate(self, *args):
+        """ None: Refetch the last cached page and any pages after it. """
+        batches, store = self.batches, self.store
+        loop = asyncio.get_running_loop()
+
+        count, page = await loop.run_in_executor(None, store.tail, args)
+        offset = int(page["MRData"]["offset"])
+        pages = [x async for x in batches(*args, offset=offset)]
+        await loop.run_in_executor(None, store.save, args, pages, count - 1)
+
+    async def rows(self, *args):
+        """ AsyncIterator[Record]: Typed rows of a query, one page at a time. """
+        records = Records()
+
+        async for page in self(*args):
+            for record in records(page):
+                yield record
+
+    # Helpers
+
+    async def fetch(self, url, timeout=TIMEOUT):
+        """
+        bytes: Response body. Reuses an idle connection if possible.
+        Resends right away, once, if the server closed a reused connection.
+        """
+        pace, state = self.pace, self.state
+
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        target = f"{parts.path}?{parts.query}" if parts.query else parts.path
+        request = f"GET {target} HTTP/1.1\r\nHost: {parts.netloc}\r\n"
+        request += "Accept: application/json\r\nConnection: keep-alive\r\n\r\n"
+
+        async def opened():
+            https = parts.scheme == "https"
+            port = parts.port or (443 if https else 80)
+            host, ssl = parts.hostname, (https or None)
+            opening = asyncio.open_connection(host, port, ssl=ssl)
+            return await asyncio.wait_for(opening, timeout)
+
+        async def exchanged(reader, writer):
+            writer.write(request.encode("latin-1"))
+            await writer.drain()
+            return await asyncio.wait_for(responded(reader), timeout)
+
+        async with state.gate:
+            await pace()
+            reused = bool(state.idle.get(key))
+            reader, writer = state.idle[key].pop() if reused else await opened()
+
+            try:
+                try:
+                    status, reason, body, keep = await exchanged(reader, writer)
+                except (BrokenPipeError, ConnectionResetError):
+                    if not reused:
+                        raise
+                    writer.close()
+                    reader, writer = await opened()
+                    status, reason, body, keep = await exchanged(reader, writer)
+                if status != 200:
+                    raise HTTPException(f"{status} {reason}")
+            except BaseException:
+                writer.close()
+                raise
+
+        if keep:
+            state.idle.setdefault(key, []).append((reader, writer))
+        else:
+            writer.close()
+
+        return body
+
+    async def pace(self):
+        """ None: Wait until the rate limit allows another request. """
+        lock, rate = self._lock, self.rate
+
+        if rate > 0:
+            with lock:
+                now = monotonic()
+                start = max(now, self._next)
+                self._next = start + 1 / rate
+            await asyncio.sleep(start - now)
+
+    async def reply(self, *args, offset=0):
+        """ dict: Data extracted from query reply. """
+        base, fetch = self.base, self.fetch
+        limit, retries, timeout = self.limit, self.retries, self.timeout
+
+        path = "/".join(map(str, args)) + ".json"
+        url = f"{base}/{path}?limit={limit}&offset={offset}"
+        print(f"GET {url}")
+
+        for itry in reversed(range(1 + retries)):
+            try:
+                return loads(await fetch(url, timeout=timeout))
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as err:
+                if itry:
+                    warn(f"Retry in {timeout} seconds because {err}")
+                    await asyncio.sleep(timeout)
+                    timeout *= 2
+                else:
+                    warn(f"Gave up after {retries} retries.")
+                    raise err
+
+    @property
+    def state(self):
+        """ SimpleNamespace: Semaphore and idle connections for this event loop. """
+        loop, loops, workers = asyncio.get_running_loop(), self._loops, self.workers
+
+        if loop not in loops:
+            gate = asyncio.Semaphore(max(1, workers))
+            loops[loop] = SimpleNamespace(gate=gate, idle={})
+
+        return loops[loop]
+
+    async def tabled(self, table):
+        """ List[namedtuple]: Rows of a pre-formatted f1 table. """
+        return tabulated(table, await self.collect("f1", table))
+
+
+class FolderStore:
+    """
+    Cache pages as JSON files in a folder tree, one folder per query.
+
+    Pages are written to temporary files first and renamed into place
+    only after the whole query arrives, so an interrupted download
+    never leaves a half-saved query behind. File modification times
+    record when each page was fetched.
+
+    Inputs
+        folder      Path or str: Cache folder.
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.folder})"
+
+    def erase(self, args):
+        """ None: Delete any cached pages. """
+        for path in self.paths(args):
+            print(f"rm {path}")
+            path.unlink()
+
+    def exists(self, args):
+        """ bool: True if any pages are cached for this query. """
+        return any(self.querypath(args).glob("*.json"))
+
+    def fetched(self, args):
+        """ float or None: Unix time of the newest cached page. """
+        times = [x.stat().st_mtime for x in self.paths(args)]
+
+        return max(times) if times else None
+
+    def load(self, args):
+        """ Iterator[dict]: Cached pages in order. """
+        for path in self.paths(args):
+            with open(path) as file:
+                yield load(file)
+
+    def paths(self, args):
+        """ List[Path]: Cached page files sorted by page number. """
+        paths = self.querypath(args).glob("*.json")
+
+        return sorted(paths, key=lambda x: int(x.stem) if x.stem.isdigit() else -1)
+
+    def queries(self):
+        """ Iterator[tuple]: Query parameters of every cached query. """
+        folders = sorted({x.parent for x in self.folder.rglob("*.json")})
+
+        return (x.relative_to(self.folder).parts for x in folders)
+
+    def querypath(self, args):
+        """ Path: Path to cache folder. """
+        return self.folder.joinpath(*map(str, args))
+
+    def save(self, args, pages, start=0):
+        """ None: Replace old pages from page number start onward. """
+        paths, querypath = self.paths, self.querypath
+
+        folder = querypath(args)
+        if not folder.exists():
+            print(f"mkdir {folder}")
+            folder.mkdir(parents=True)
+
+        temps = []
+        try:
+            for i, data in enumerate(pages, start):
+                path = (folder / str(i)).with_suffix(".json.tmp")
+                temps.append(path)
+                with open(path, "w") as file:
+                    print(f"save {path.with_suffix('')}")
+                    dump(data, file, allow_nan=False, indent=2)
+        except BaseException:
+            for path in temps:
+                if path.exists():
+                    path.unlink()
+            raise
+
+        for path in paths(args)[start:]:
+            print(f"rm {path}")
+            path.unlink()
+        for path in temps:
+            replace(path, path.with_suffix(""))
+
+    def tail(self, args):
+        """ tuple: Number of cached pages and the last page. """
+        paths = self.paths(args)
+        with open(paths[-1]) as file:
+            return len(paths), load(file)
+
+
+class SQLiteStore:
+    """
+    Cache pages in one SQLite file, keyed by query and offset.
+
+    Pages are stored as zlib-compressed compact JSON with the time they were
+    fetched. Each query is saved in one transaction, so readers see either
+    all old pages or all new ones.
+    An index on (query, offset) makes existence checks a single lookup,
+    which beats globbing thousands of folders on a network filesystem.
+
+    Inputs
+        path        Path or str: Database file. Created if it does not exist.
+        level       int: zlib compression level.
+
+    Import an existing cache folder.
+    >>> migrate(FolderStore('path/to/cache/folder'), SQLiteStore('cache.sqlite'))
+    """
+
+    def __init__(self, path, level=LEVEL):
+        self.path = Path(path)
+        self.level = int(level)
+        self._db = None
+        self._lock = Lock()
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.path})"
+
+    @property
+    def db(self):
+        """ Connection: Database connection. Creates tables if necessary. """
+        with self._lock:
+            if self._db is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                db = connect(self.path, check_same_thread=False)
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS pages ("
+                    "query TEXT NOT NULL, "
+                    "offset INTEGER NOT NULL, "
+                    "data BLOB NOT NULL, "
+                    "fetched REAL NOT NULL DEFAULT 0, "
+                    "PRIMARY KEY (query, offset)"
+                    ") WITHOUT ROWID"
+                )
+                cols = [x[1] for x in db.execute("PRAGMA table_info(pages)")]
+                if "fetched" not in cols:
+                    sql = "ALTER TABLE pages ADD COLUMN fetched REAL NOT NULL DEFAULT 0"
+                    db.execute(sql)
+                db.commit()
+                self._db = db
+
+        return self._db
+
+    def erase(self, args):
+        """ None: Delete any cached pages. """
+        db, lock, query = self.db, self._lock, self.query(args)
+
+        with lock, db:
+            print(f"rm {self.path} {query}")
+            db.execute("DELETE FROM pages WHERE query = ?", (query,))
+
+    def exists(self, args):
+        """ bool: True if any pages are cached for this query. """
+        db, lock, query = self.db, self._lock, self.query(args)
+
+        with lock:
+            sql = "SELECT 1 FROM pages WHERE query = ? LIMIT 1"
+            return db.execute(sql, (query,)).fetchone() is not None
+
+    def fetched(self, args):
+        """ float or None: Unix time of the newest cached page. """
+        db, lock, query = self.db, self._lock, self.query(args)
+
+        with lock:
+            sql = "SELECT MAX(fetched) FROM pages WHERE query = ?"
+            return db.execute(sql, (query,)).fetchone()[0]
+
+    def load(self, args):
+        """ Iterator[dict]: Cached pages in order. """
+        db, lock, query = self.db, self._lock, self.query(args)
+
+        with lock:
+            sql = "SELECT data FROM pages WHERE query = ? ORDER BY offset"
+            rows = db.execute(sql, (query,)).fetchall()
+
+        return (loads(decompress(x)) for x, in rows)
+
+    def queries(self):
+        """ Iterator[tuple]: Query parameters of every cached query. """
+        db, lock = self.db, self._lock
+
+        with lock:
+            rows = db.execute("SELECT DISTINCT query FROM pages ORDER BY query")
+            rows = rows.fetchall()
+
+        return (tuple(x.split("/")) for x, in rows)
+
+    @staticmethod
+    def query(args):
+        """ str: Database key for query parameters. """
+        return "/".join(map(str, args))
+
+    def save(self, args, pages, start=0):
+        """ None: Replace old pages from page number start onward. """
+        db, level, lock, query = self.db, self.level, self._lock, self.query(args)
+
+        rows, now = [], time()
+        for i, data in enumerate(pages, start):
+            offset = int(data.get("MRData", {}).get("offset", i))
+            text = dumps(data, allow_nan=False, separators=(",", ":"))
+            rows.append((query, offset, compress(text.encode(), level), now))
+
+        with lock, db:
+            print(f"save {self.path} {query}")
+            sql = "SELECT offset FROM pages WHERE query = ? ORDER BY offset"
+            old = [x for x, in db.execute(sql, (query,)).fetchall()[start:]]
+            sql = "DELETE FROM pages WHERE query = ? AND offset = ?"
+            db.executemany(sql, ((query, x) for x in old))
+            db.executemany("INSERT INTO pages VALUES (?, ?, ?, ?)", rows)
+
+    def tail(self, args):
+        """ tuple: Number of cached pages and the last page. """
+        db, lock, query = self.db, self._lock, self.query(args)
+
+        with lock:
+            sql = "SELECT COUNT(*), MAX(offset) FROM pages WHERE query = ?"
+            count, offset = db.execute(sql, (query,)).fetchone()
+            sql = "SELECT data FROM pages WHERE query = ? AND offset = ?"
+            data, = db.execute(sql, (query, offset)).fetchone()
+
+        return count, loads(decompress(data))
+
+
+class Columns:
+    """
+    Collect records into preallocated numpy columns, then a pandas DataFrame.
+
+    Needs numpy and pandas, which are imported only when columns are filled.
+    Columns start at the expected row count and double whenever they fill up.
+    Integer columns become nullable Int64 so missing values survive.
+
+    Inputs
+        size        int: Expected number of rows.
+    """
+
+    def __init__(self, size=LIMIT):
+        self.arrays = {}
+        self.count = 0
+        self.size = max(1, int(size))
+
+    def __repr__(self):
+        return f"{type(self).__name__}(count={self.count}, size={self.size})"
+
+    def append(self, record):
+        """ None: Add one record. New columns are filled with missing values. """
+        arrays, blank, count = self.arrays, self.blank, self.count
+
+        if count == self.size:
+            self.grow()
+        for key, value in zip(record.__slots__, record):
+            if key not in arrays:
+                arrays[key] = blank(key, self.size)
+            if value is not None:
+                arrays[key][count] = value
+        self.count += 1
+
+    def blank(self, key, size):
+        """ ndarray: Column of missing values. """
+        from numpy import full, nan
+
+        if TYPES.get(key.rsplit("_", 1)[-1]):
+            return full(size, nan)
+        else:
+            return full(size, None, dtype=object)
+
+    def frame(self):
+        """ DataFrame: Collected columns trimmed to the number of rows. """
+        from pandas import DataFrame, array
+
+        arrays, count = self.arrays, self.count
+        data = {}
+        for key, values in arrays.items():
+            if TYPES.get(key.rsplit("_", 1)[-1]) is int:
+                data[key] = array(values[:count], dtype="Int64")
+            else:
+                data[key] = values[:count]
+
+        return DataFrame(data, index=range(count))
+
+    def grow(self):
+        """ None: Double the room in every column. """
+        arrays, blank, size = self.arrays, self.blank, self.size
+
+        for key, values in arrays.items():
+            more = blank(key, 2 * size)
+            more[:size] = values
+            arrays[key] = more
+        self.size = 2 * size
+
+
+class Record:
+    """ Compact row with one slot per field. Missing fields are None. """
+
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for key, value in zip(self.__slots__, values):
+            setattr(self, key, value)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and tuple(self) == tuple(other)
+
+    def __iter__(self):
+        return (getattr(self, x) for x in self.__slots__)
+
+    def __repr__(self):
+        name = type(self).__name__
+        params = ", ".join(f"{k}={v!r}" for k, v in zip(self.__slots__, self))
+
+        return f"{name}({params})"
+
+
+class Records:
+    """
+    Turn reply pages into typed records, one page at a time.
+
+    Nested replies are flattened to their innermost rows. Each row inherits
+    the fields of the items around it, so a lap timing knows its season
+    and round. Fields of nested dicts are prefixed with their keys,
+    for example Driver_driverId. Inner fields win name clashes.
+
+    The record class grows when a page brings new fields. Earlier records
+    keep their old class, so check for fields that only some rows have.
+    """
+
+    def __init__(self):
+        self.cols = {}
+        self.Row = None
+
+    def __call__(self, page):
+        """ Iterator[Record]: Records from one page. """
+        cols = self.cols
+
+        data = page["MRData"]
+        table = next(v for k, v in data.items() if k.endswith("Table"))
+        for name, row in flattened(table):
+            if (self.Row is None) or not (row.keys() <= cols.keys()):
+                cols.update(dict.fromkeys(row))
+                self.Row = recorded(name, tuple(cols))
+            yield self.Row(*(typed(k, row.get(k)) for k in cols))
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(self.cols)})"
+
+
 # Copyright © 2020 Sam Kennerly
 #
 # Licensed under the Apache License, Version 2.0 (the "License");
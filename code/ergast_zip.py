@@ -1,14 +1,121 @@
 """
 Ergast database image readers. https://ergast.com/mrd/db/
 """
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from hashlib import sha256
+from os import close, remove, replace
 from pathlib import Path
+from tempfile import mkstemp
+from threading import RLock
 from zipfile import ZipFile
 
-from pandas import read_csv, to_timedelta
+from numpy import iinfo
+from pandas import CategoricalDtype, DataFrame, Series, read_csv, to_timedelta
+from pandas.api.types import is_extension_array_dtype, is_integer_dtype
+from pandas.api.types import is_string_dtype
+
+CHUNKSIZE = 2 ** 16
+DERIVED = ("facts",)
+MEMORY = 2 ** 30
+
+try:
+    from pyarrow import OSFile, Table, ipc, memory_map
+
+    def readarrow(path):
+        """ DataFrame or Series: Read memory-mapped Arrow file. """
+        with memory_map(str(path)) as source:
+            table = ipc.open_file(source).read_all()
+            data = table.to_pandas()
+
+        return data.iloc[:, 0] if b"series" in table.schema.metadata else data
+
+    def writearrow(data, path):
+        """ None: Write DataFrame or Series to Arrow file. Replace atomically. """
+        path = Path(path)
+
+        if isinstance(data, Series):
+            table = Table.from_pandas(data.to_frame())
+            table = table.replace_schema_metadata(
+                {**table.schema.metadata, b"series": b"true"}
+            )
+        else:
+            table = Table.from_pandas(data)
+
+        # Each writer gets its own temporary file, so threads never share one.
+        fd, temp = mkstemp(dir=path.parent, prefix=f"{path.name}.", suffix=".tmp")
+        close(fd)
+        try:
+            with OSFile(temp, "wb") as sink:
+                with ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            replace(temp, path)
+        except BaseException:
+            remove(temp)
+            raise
+
+except ImportError as err:
+
+    def readarrow(path, err=err):
+        """ None: Show error caused by trying to import pyarrow. """
+        raise ImportError(f"Cannot read cached table: {err}")
+
+    def writearrow(data, path, err=err):
+        """ None: Show error caused by trying to import pyarrow. """
+        raise ImportError(f"Cannot write cached table: {err}")
+
+
+def compacted(data):
+    """ DataFrame or Series: Smallest safe integers and categorical strings. """
+    frame = DataFrame(data)
+
+    for col in frame.columns:
+        s = frame[col]
+        if isinstance(s.dtype, CategoricalDtype) or not len(s.dropna()):
+            continue
+        elif is_integer_dtype(s.dtype):
+            lo, hi = s.min(), s.max()
+            for bits in (8, 16, 32):
+                if iinfo(f"int{bits}").min <= lo and hi <= iinfo(f"int{bits}").max:
+                    nullable = is_extension_array_dtype(s.dtype)
+                    frame[col] = s.astype(f"Int{bits}" if nullable else f"int{bits}")
+                    break
+        elif is_string_dtype(s.dtype) and (2 * s.nunique() < len(s)):
+            frame[col] = s.astype("category")
+
+    return frame.iloc[:, 0] if isinstance(data, Series) else frame
+
+
+def integers(s, compact=False):
+    """ Series: Integers with missing values as 0, or nullable if compact. """
+    return s.astype("Int64") if compact else s.fillna(0).astype(int)
+
+
+def nbytes(data):
+    """ int: Memory used by DataFrame or Series, including strings. """
+    return int(DataFrame(data).memory_usage(deep=True).sum())
+
+
+def table(method):
+    """
+    property: Read-only table which ErgastZIP.load may cache.
+    Decorated methods read raw CSV data with get() and convert datatypes.
+    """
+    name = method.__name__
+
+    @wraps(method)
+    def fget(self):
+        return self.load(name, method)
+
+    return property(fget)
 
 
 def to_seconds(s):
     """ Series[float64]: Converted Series of minute:seconds.fraction strings. """
+    if s.isna().all():
+        return s.astype(float)
+
     s = s.str.partition(":")
 
     return 60 * s[0].astype(float) + s[2].astype(float)
@@ -19,11 +126,35 @@ class ErgastZIP:
     Read Formula 1 data from an https://ergast.com/mrd/db database dump.
 
     Returns pandas.Series or pandas.DataFrame objects.
-    Reads CSV files inside a ZIP file. Does not save or modify files.
+    Reads CSV files inside a ZIP file. Does not modify the ZIP file.
     Converts to pandas-friendly datatypes. Renames or drops some columns.
 
+    Set a cache folder to save typed tables as Arrow files after first read.
+    Later reads are memory-mapped. Requires pyarrow.
+    Cached tables are keyed by ZIP file size, mtime, and SHA-256 hash,
+    so replacing the ZIP file starts a new cache.
+
+    Tables also stay in memory until they exceed a budget in bytes.
+    Least recently used tables are dropped first. Callers get copies,
+    so changing a returned table does not change the one in memory.
+    Tables read from an older ZIP file are never returned.
+    Call refresh() to free memory used by tables from an older ZIP file.
+
+    Call iter_table() to stream big tables in chunks with optional filters.
+    Call load_many() to read several tables at once on a thread pool.
+    Most analyses can start from facts: race results joined to race, circuit,
+    driver, status, and team names, indexed by (season, round, id_race).
+
+    Set compact=True to downcast integers to the smallest safe type and
+    store repeated strings as categoricals. Integers which would be filled
+    with 0 become nullable integers instead. Check savings with .saved.
+    All reads share one open ZipFile, which is safe to use from threads.
+
     Inputs
         path    Path or str: Path to ZIP file containing CSVs.
+        cache   Path, str or None: Cache folder. Input None to disable cache.
+        memory  int: Maximum bytes of tables in memory. Input 0 to disable.
+        compact bool: Use smaller datatypes. Missing integers stay missing.
 
     Create an ErgastF1 which reads from a specific ZIP file.
     >>> tables = ErgastF1('path/to/ergast/data.zip')
@@ -32,90 +163,298 @@ class ErgastZIP:
     >>> tables.circuits
     >>> tables.drivers
 
+    Cache tables as Arrow files in a separate folder.
+    >>> tables = ErgastF1('path/to/ergast/data.zip', cache='path/to/cache')
+
     For smaller queries, use the Ergast API: https://ergast.com/mrd
     """
 
-    def __init__(self, path):
+    def __init__(self, path, cache=None, memory=MEMORY, compact=False):
         self.path = Path(path).resolve()
+        self.cache = Path(cache).resolve() if cache else None
+        self.memory = int(memory)
+        self.compact = bool(compact)
+        self._key = None
+        self._lock = RLock()
+        self._memo = OrderedDict()
+        self._saved = dict()
+        self._stamp = None
+        self._zipped = None
 
     def __repr__(self):
         name = type(self).__name__
-        params = ", ".join(f"{k}={v}" for k, v in vars(self).items())
+        params = vars(self).items()
+        params = ", ".join(f"{k}={v}" for k, v in params if not k.startswith("_"))
 
         return f"{name}({params})"
 
+    def chunks(self, name, where=(), **kwargs):
+        """ Iterator[DataFrame]: Read CSV file in chunks. Skip unwanted rows. """
+        archive = self.archive
+        kwargs.setdefault("header", None)
+        kwargs.setdefault("index_col", "id")
+        kwargs.setdefault("na_values", ["\\N"])
+        name = Path(name).with_suffix(".csv").name
+
+        with archive.open(name) as file:
+            for data in read_csv(file, **kwargs):
+                for col, keep in dict(where).items():
+                    if col == "id":
+                        data = data.loc[data.index.isin(keep)]
+                    elif col in data.columns:
+                        data = data.loc[data[col].isin(keep)]
+                    else:
+                        raise ValueError(f"Cannot filter {name} by {col}")
+                if len(data):
+                    yield data.rename_axis(None)
+
     def get(self, name, **kwargs):
         """ DataFrame: Read CSV file inside ZIP file. """
-        path = self.path
+        archive = self.archive
         kwargs.setdefault("header", None)
         kwargs.setdefault("index_col", "id")
         kwargs.setdefault("na_values", ["\\N"])
         name = Path(name).with_suffix(".csv").name
 
-        with ZipFile(path) as zed:
-            with zed.open(name) as file:
-                data = read_csv(file, **kwargs)
+        with archive.open(name) as file:
+            data = read_csv(file, **kwargs)
 
         return data.rename_axis(None)
 
+    def iter_table(
+        self, name, chunksize=CHUNKSIZE, races=None, drivers=None, seasons=None
+    ):
+        """
+        Iterator[DataFrame or Series]: Typed chunks of a table.
+        Streams rows from the ZIP file without reading the whole table.
+        Drops rows by race ID, driver ID, and/or season before converting.
+        Raises ValueError if the table has no column for a filter.
+        >>> laps = tables.iter_table("lap_times", seasons=[2018, 2019])
+        """
+        if name in DERIVED:
+            raise ValueError(f"Cannot stream derived table {name}")
+        method = getattr(type(self), name).fget.__wrapped__
+
+        where = dict()
+        if races is not None:
+            where["id_race"] = set(races)
+        if (seasons is not None) and (name == "races"):
+            where["season"] = set(seasons)
+        elif seasons is not None:
+            data = self.races
+            found = set(data.index[data["season"].isin(list(seasons))])
+            where["id_race"] = where.get("id_race", found) & found
+        if drivers is not None:
+            where["id_driver"] = set(drivers)
+
+        own = {"drivers": "id_driver", "races": "id_race"}.get(name)
+        if own in where:
+            where["id"] = where.pop(own)
+
+        chunks = None
+
+        def get(csvname, **kwargs):
+            nonlocal chunks
+            if chunks is None:
+                kwargs["chunksize"] = chunksize
+                chunks = self.chunks(csvname, where, **kwargs)
+            return next(chunks)
+
+        try:
+            while True:
+                data = method(self, get)
+                if chunks is None:
+                    raise ValueError(f"Cannot stream derived table {name}")
+                yield data
+        except StopIteration:
+            return
+        finally:
+            if chunks is not None:
+                chunks.close()
+
+    @property
+    def key(self):
+        """ str: Cache key from ZIP file size, mtime, and hash. """
+        path = self.path
+
+        stat = path.stat()
+        with self._lock:
+            if self._stamp != (stat.st_size, stat.st_mtime_ns):
+                digest = sha256()
+                with open(path, "rb") as file:
+                    for block in iter(lambda: file.read(2 ** 20), b""):
+                        digest.update(block)
+
+                self._stamp = (stat.st_size, stat.st_mtime_ns)
+                self._key = "{}-{}-{}".format(*self._stamp, digest.hexdigest()[:16])
+
+            return self._key
+
+    @property
+    def archive(self):
+        """ ZipFile: Shared, thread-safe reader. Reopens if ZIP file changed. """
+        path = self.path
+
+        stat = path.stat()
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            zipped = self._zipped
+            if (zipped is None) or (zipped[0] != stamp):
+                if zipped is not None:
+                    zipped[1].close()
+                zipped = self._zipped = (stamp, ZipFile(path))
+
+        return zipped[1]
+
+    def cached(self, name, method):
+        """ DataFrame or Series: Table from cache, or from method if not cached. """
+        cache = self.cache
+
+        if not cache:
+            return self.read(name, method)
+
+        suffix = ".compact.arrow" if self.compact else ".arrow"
+        path = (cache / self.key / name).with_suffix(suffix)
+        if path.is_file():
+            return readarrow(path)
+
+        data = self.read(name, method)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        writearrow(data, path)
+
+        return data
+
+    def load(self, name, method):
+        """ DataFrame or Series: Table from memory, cache, or method. """
+        lock, memo, memory = self._lock, self._memo, self.memory
+
+        with lock:
+            key = (self.key, name, self.compact)
+            if key in memo:
+                memo.move_to_end(key)
+                return memo[key][0].copy()
+
+        data = self.cached(name, method)
+        size = nbytes(data)
+        kept = size <= memory
+        with lock:
+            if kept:
+                memo[key] = (data, size)
+                while sum(x for _, x in memo.values()) > memory:
+                    memo.popitem(last=False)
+
+        # Only tables kept in memory are shared, so only they need copying.
+        return data.copy() if kept else data
+
+    def read(self, name, method):
+        """ DataFrame or Series: Table from method. Compacted if compact=True. """
+        data = method(self, self.get)
+
+        if self.compact:
+            size = nbytes(data)
+            data = compacted(data)
+            with self._lock:
+                self._saved[name] = size - nbytes(data)
+
+        return data
+
+    def refresh(self, force=False):
+        """ None: Forget tables in memory if forced or if ZIP file changed. """
+        key, memo = self.key, self._memo
+
+        with self._lock:
+            for old in [x for x in memo if force or (x[0] != key)]:
+                del memo[old]
+
+    def load_many(self, names, workers=None):
+        """ Dict[str, DataFrame]: Read several tables at once on a thread pool. """
+        names = list(names)
+        with ThreadPoolExecutor(workers) as pool:
+            tables = pool.map(partial(getattr, self), names)
+
+        return dict(zip(names, tables))
+
+    @property
+    def saved(self):
+        """ Series: Bytes saved by compact=True for each table read so far. """
+        return Series(self._saved, name="saved", dtype=int).sort_index()
+
     @property
     def tables(self):
         """ List[str]: Table names. """
-        path = self.path
-        with ZipFile(path) as zf:
-            return zf.namelist()
+        return self.archive.namelist()
+
+    # Derived tables
+
+    @table
+    def facts(self, get):
+        names = "circuits drivers races results status teams".split()
+        tables = self.load_many(names)
+        races = tables["races"]["season round race date id_circuit".split()]
+
+        data = tables["results"].rename_axis("id_result").reset_index()
+        data = data.join(races, on="id_race")
+        data = data.join(tables["circuits"]["circuit"], on="id_circuit")
+        data = data.join(tables["drivers"]["driver"], on="id_driver")
+        data = data.join(tables["status"], on="id_status")
+        data = data.join(tables["teams"]["team"], on="id_team")
+        for col in "circuit driver race status team".split():
+            data[col] = data[col].astype("category")
+        data = data.set_index("season round id_race".split()).sort_index()
+
+        return data.sort_index(axis=1)
 
     # Series
 
-    @property
-    def seasons(self):
-        get, kw = self.get, {}
+    @table
+    def seasons(self, get):
+        kw = {}
         kw["index_col"] = None
         kw["names"] = "year url".split()
 
         return get("seasons.csv", **kw).pop("year")
 
-    @property
-    def status(self):
-        get, kw = self.get, {}
+    @table
+    def status(self, get):
+        kw = {}
         kw["names"] = "id status".split()
 
         return get("status.csv", **kw).pop("status")
 
     # DataFrames
 
-    @property
-    def circuits(self):
-        get, kw = self.get, {}
+    @table
+    def circuits(self, get):
+        kw = {}
         kw["names"] = "id ref circuit city country latitude longitude alt url".split()
         kw["usecols"] = set(kw["names"]) - {"alt"}
         data = get("circuits.csv", **kw)
 
         return data.sort_index(axis=1)
 
-    @property
-    def drivers(self):
-        get, kw = self.get, {}
+    @table
+    def drivers(self, get):
+        kw = {}
         kw["names"] = "id ref number code first last birthday nation url".split()
         kw["parse_dates"] = ["birthday"]
         data = get("driver.csv", **kw)
-        data["number"] = data["number"].fillna(0).astype(int)
+        data["number"] = integers(data["number"], self.compact)
         data["driver"] = data.pop("first").str.cat(data.pop("last"), sep=" ")
 
         return data.sort_index(axis=1)
 
-    @property
-    def driver_standings(self):
-        get, kw = self.get, {}
+    @table
+    def driver_standings(self, get):
+        kw = {}
         kw["names"] = "id id_race id_driver points pos pos_str wins".split()
         kw["usecols"] = set(kw["names"]) - {"pos_str"}
         data = get("driver_standings.csv", **kw)
 
         return data.sort_index(axis=1)
 
-    @property
-    def lap_times(self):
-        get, kw = self.get, {}
+    @table
+    def lap_times(self, get):
+        kw = {}
         kw["index_col"] = None
         kw["names"] = "id_race id_driver lap pos time msec".split()
         kw["usecols"] = set(kw["names"]) - {"time"}
@@ -124,9 +463,9 @@ class ErgastZIP:
 
         return data.sort_index(axis=1)
 
-    @property
-    def pit_stops(self):
-        get, kw = self.get, {}
+    @table
+    def pit_stops(self, get):
+        kw = {}
         kw["index_col"] = None
         kw["names"] = "id_race id_driver stop lap time duration_str duration".split()
         kw["usecols"] = set(kw["names"]) - {"duration_str"}
@@ -136,9 +475,9 @@ class ErgastZIP:
 
         return data.sort_index(axis=1)
 
-    @property
-    def qualifying(self):
-        get, kw, qcols = self.get, {}, "q1 q2 q3".split()
+    @table
+    def qualifying(self, get):
+        kw, qcols = {}, "q1 q2 q3".split()
         kw["names"] = "id id_race id_driver id_team number pos q1 q2 q3".split()
         data = get("qualifying.csv", **kw)
         for col in qcols:
@@ -146,9 +485,9 @@ class ErgastZIP:
 
         return data.sort_index(axis=1)
 
-    @property
-    def races(self):
-        get, kw = self.get, {}
+    @table
+    def races(self, get):
+        kw = {}
         kw["names"] = "id season round id_circuit race date time url".split()
         kw["parse_dates"] = ["date", "time"]
         data = get("races.csv", **kw)
@@ -156,9 +495,9 @@ class ErgastZIP:
 
         return data.sort_index(axis=1)
 
-    @property
-    def results(self):
-        get, kw = self.get, {}
+    @table
+    def results(self, get):
+        kw = {}
         kw["names"] = "id id_race id_driver id_team number grid pos pos_text".split()
         kw["names"] += "order points laps time msec fastlap rank".split()
         kw["names"] += "fastlap_sec fastlap_kph id_status".split()
@@ -168,30 +507,30 @@ class ErgastZIP:
         data["sec"] = data.pop("msec") / 1000
         data["fastlap_sec"] = to_seconds(data["fastlap_sec"])
         for col in "number fastlap rank pos".split():
-            data[col] = data[col].fillna(0).astype(int)
+            data[col] = integers(data[col], self.compact)
 
         return data.sort_index(axis=1)
 
-    @property
-    def teams(self):
-        get, kw = self.get, {}
+    @table
+    def teams(self, get):
+        kw = {}
         kw["names"] = "id ref team nation url".split()
         data = get("constructors.csv", **kw)
 
         return data.sort_index(axis=1)
 
-    @property
-    def team_results(self):
-        get, kw = self.get, {}
+    @table
+    def team_results(self, get):
+        kw = {}
         kw["names"] = "id id_race id_team points status".split()
         data = get("constructor_results.csv", **kw)
         data["dsq"] = data.pop("status") == "D"
 
         return data.sort_index(axis=1)
 
-    @property
-    def team_standings(self):
-        get, kw = self.get, {}
+    @table
+    def team_standings(self, get):
+        kw = {}
         kw["names"] = "id id_race id_team points pos pos_str wins".split()
         kw["usecols"] = set(kw["names"]) - {"pos_str"}
         data = get("constructor_standings.csv", **kw)
@@ -1,8 +1,55 @@
-from numpy import fromiter, linspace, tanh
-from numpy.random import randn
-from pandas import Categorical, DataFrame
-from scipy.sparse import coo_matrix, diags, identity
-from scipy.sparse.csgraph import laplacian
+from concurrent.futures import ThreadPoolExecutor
+
+from numpy import arange, bincount, cumsum, diff, empty, int64, linspace, repeat, tanh
+from numpy import array, array_split, concatenate, isfinite, stack, unique
+from numpy import minimum, nan, ones, sqrt, trim_zeros, where, zeros, zeros_like
+from numpy.random import RandomState, randn
+from pandas import Categorical, DataFrame, Index, MultiIndex, Series, factorize
+from pandas import read_csv
+from scipy.sparse import csr_matrix, diags, identity
+from scipy.sparse.csgraph import dijkstra, laplacian, shortest_path
+
+CHUNKSIZE = 2 ** 16
+DEPTH = 16
+JITTER = 1.0
+NUDGE = 0.01
+PIVOTS = 64
+THETA = 0.5
+WARM = 0.1
+
+
+def linked(links):
+    """
+    Tuple[csr_matrix, Index]: Summed link weights and sorted node names.
+    Factorizes sources and targets in one pass. Sums duplicates into CSR.
+    """
+    links = DataFrame(links)
+
+    nlinks = len(links)
+    ends = concatenate([links.iloc[:, 0].values, links.iloc[:, 1].values])
+    codes, nodes = factorize(ends, sort=True)
+    i, j = codes[:nlinks], codes[nlinks:]
+    if links.shape[1] > 2:
+        k = links.iloc[:, 2].fillna(0).values
+    else:
+        k = ones(nlinks, dtype=int64)
+
+    valid = (i >= 0) & (j >= 0)
+    n = len(nodes)
+    matrix = csr_matrix((k[valid], (i[valid], j[valid])), shape=(n, n))
+    matrix.sum_duplicates()
+    matrix.eliminate_zeros()
+
+    used = (matrix.getnnz(axis=0) + matrix.getnnz(axis=1)) > 0
+    if not used.all():
+        matrix, nodes = matrix[used][:, used], nodes[used]
+
+    return matrix, Index(nodes)
+
+
+def hopped(hops):
+    """ ndarray[int]: Shortest path lengths with -1 for unreachable nodes. """
+    return where(isfinite(hops), hops, -1).astype(int64)
 
 
 def limited(z, maxr):
@@ -14,21 +61,179 @@ def limited(z, maxr):
     return rad * z
 
 
+def exhausted(items):
+    """ Tuple[object, object]: Last item and return value of a generator. """
+    item = None
+    while True:
+        try:
+            item = next(items)
+        except StopIteration as stop:
+            return item, stop.value
+
+
+def netforce(repel, matrix, points, rows):
+    """ ndarray: Repulsion minus attraction on selected rows. """
+    return repel(rows) - matrix.dot(points.T).T
+
+
+def rms(z):
+    """ ndarray: Root-mean-square magnitude along last axis. """
+    return sqrt((z.real * z.real + z.imag * z.imag).mean(axis=-1))
+
+
+def swinging(forces, prior, mass, glide, jitter, heat=1.0):
+    """
+    Tuple[ndarray, ndarray]: Global and per-node speeds from ForceAtlas2.
+    Swing is how much a node's force changed since the last step.
+    Traction is how much it kept pulling the same way.
+    Global speed rises by at most 50% per step and never exceeds heat.
+    """
+    swing = abs(forces - prior)
+    traction = abs(forces + prior) / 2
+
+    ratio = (mass * traction).sum(axis=-1) / (mass * swing).sum(axis=-1)
+    glide = minimum(jitter * ratio, 1.5 * glide).clip(None, heat)
+    speed = glide[..., None] / (1 + glide[..., None] * sqrt(swing))
+
+    return glide, speed
+
+
+def tabled(matrix, nodes):
+    """ DataFrame: [source, target, weight] for each nonzero matrix element. """
+    matrix = matrix.tocoo()
+
+    links = DataFrame()
+    links["source"] = Categorical.from_codes(matrix.row, categories=nodes)
+    links["target"] = Categorical.from_codes(matrix.col, categories=nodes)
+    links["weight"] = matrix.data
+
+    return links
+
+
 def weighted(links):
     """ DataFrame: [source, target, weight] for each link. """
-    links = DataFrame(links)
+    return tabled(*linked(links))
+
 
-    cols = list(links.columns)
-    links = links.groupby(cols[0:2], observed=True)
-    links = links[cols[2]].sum() if (len(cols) > 2) else links.size().rename("_")
-    links = links.loc[links.ne(0)].reset_index()
-    links.columns = "source target weight".split()
+class Repulsion:
+    """
+    Exact node-node repulsion with vectorized NumPy kernels.
+
+    Init with complex node positions. Call with row indices to get forces.
+    Computes pairwise differences in chunks of at most chunksize elements,
+    so the full (n, n) matrix is never stored in memory.
+    """
 
-    nodes = sorted(set(links["source"].unique()) | set(links["target"].unique()))
-    for col in "source target".split():
-        links[col] = Categorical(links[col], categories=nodes)
+    def __init__(self, points, chunksize=CHUNKSIZE):
+        self.points = points
+        self.chunksize = int(chunksize)
 
-    return links
+    def __call__(self, rows=slice(None)):
+        """ ndarray: Mean repulsion on selected points from all points. """
+        chunksize, points = self.chunksize, self.points
+
+        rows = arange(points.shape[-1])[rows]
+        step = max(1, chunksize // points.size)
+        forces = empty(points.shape[:-1] + rows.shape, dtype=points.dtype)
+        for i in range(0, len(rows), step):
+            z = points[..., rows[i : i + step], None] - points[..., None, :]
+            z /= (z * z.conj()).real.clip(1e-9, None)
+            forces[..., i : i + step] = z.mean(axis=-1)
+
+        return forces
+
+
+class Quadtree:
+    """
+    Barnes-Hut approximation of node-node repulsion.
+
+    Init with complex node positions. Call with row indices to get forces.
+    Sorts nodes into quadtree cells by Morton code, one level at a time.
+    Cells which look smaller than theta from a node act as one heavy node.
+    Smaller theta is more accurate. Set theta=0 for (slow) exact forces.
+    Stacked (k, n) inputs get one tree for each of the k layouts.
+    """
+
+    def __init__(self, points, theta=THETA, depth=DEPTH):
+        self.points = points
+        self.theta = float(theta)
+        self.depth = int(depth)
+
+        layouts = points.reshape(-1, points.shape[-1])
+        self.trees = [self.tree(z, self.depth) for z in layouts]
+
+    def __call__(self, rows=slice(None)):
+        """ ndarray: Approximate mean repulsion on selected points. """
+        points, theta, trees = self.points, self.theta, self.trees
+
+        layouts = points.reshape(-1, points.shape[-1])
+        rows = arange(points.shape[-1])[rows]
+        forces = [self.walk(z, tree, rows, theta) for z, tree in zip(layouts, trees)]
+
+        return stack(forces).reshape(points.shape[:-1] + rows.shape)
+
+    @classmethod
+    def tree(cls, points, depth):
+        """ List[list]: [width, keys, cell, count, sum, first, nkids] per level. """
+        x, y = points.real, points.imag
+        side = 2 ** depth
+        size = max(x.max() - x.min(), y.max() - y.min(), 1e-9)
+        ix = ((x - x.min()) * (side / size)).astype(int64).clip(0, side - 1)
+        iy = ((y - y.min()) * (side / size)).astype(int64).clip(0, side - 1)
+
+        morton = zeros_like(ix)
+        for bit in range(depth):
+            morton |= ((ix >> bit) & 1) << (2 * bit + 1)
+            morton |= ((iy >> bit) & 1) << (2 * bit)
+
+        levels = []
+        for level in range(1 + depth):
+            keys = morton >> (2 * (depth - level))
+            cells, which, counts = unique(keys, return_inverse=True, return_counts=True)
+            sums = bincount(which, x, len(cells)) + 1j * bincount(which, y, len(cells))
+            levels.append([size / 2 ** level, cells, which, counts, sums])
+
+        for parent, child in zip(levels, levels[1:]):
+            first = (child[1] >> 2).searchsorted(parent[1])
+            parent.append(first)
+            parent.append(diff(first, append=len(child[1])))
+        levels[-1] += [None, None]
+
+        return levels
+
+    @classmethod
+    def walk(cls, points, levels, rows, theta):
+        """ ndarray: Mean repulsion on selected rows from one quadtree. """
+        nrows = len(rows)
+        forces = zeros(nrows, dtype=points.dtype)
+
+        pairs = arange(nrows)
+        cells = zeros_like(pairs)
+        for width, _, which, counts, sums, first, nkids in levels:
+            z = points[rows[pairs]]
+            own = which[rows[pairs]] == cells
+            mass = counts[cells] - own
+            delta = z - (sums[cells] - own * z) / mass.clip(1, None)
+            dist2 = (delta.real * delta.real + delta.imag * delta.imag).clip(1e-9, None)
+
+            far = (width * width < theta * theta * dist2) | (first is None)
+            done = far & (mass > 0)
+            delta = mass[done] * delta[done] / dist2[done]
+            forces.real += bincount(pairs[done], delta.real, nrows)
+            forces.imag += bincount(pairs[done], delta.imag, nrows)
+            if first is None:
+                break
+
+            pairs, cells = pairs[~far], cells[~far]
+            nkid = nkids[cells]
+            skip = repeat(cumsum(nkid) - nkid, nkid)
+            pairs = repeat(pairs, nkid)
+            cells = repeat(first[cells], nkid) + arange(len(pairs)) - skip
+
+        return forces / len(points)
+
+
+FORCES = {"exact": Repulsion, "barneshut": Quadtree}
 
 
 class Graph:
@@ -39,34 +244,45 @@ class Graph:
     Stores graph links as DataFrame with 3 columns: source, target, weight.
     'source' and 'target' are (node, node) pairs as Categorical variables.
     'weight' sums link weights if they exist; else it counts duplicated links.
-    """
 
-    def __init__(self, graph):
-        self.links = graph.links if isinstance(graph, type(self)) else weighted(graph)
+    Node-node repulsion is computed by a pluggable force backend:
+        "exact"     Repulsion: vectorized in chunks. Default.
+        "barneshut" Quadtree: Barnes-Hut approximation for big graphs.
+    Extra keyword arguments (chunksize, theta, depth) go to the backend.
+    Any callable with the same interface as Repulsion also works.
 
-    def __call__(self, nsteps, x=(), y=()):
-        matrix, nodes = self.matrix, self.nodes
+    Set workers > 1 to split each step into blocks of nodes on a thread pool.
+    Threads share the positions array, and NumPy releases the GIL.
 
-        dtype = "complex128"
-        nrows = len(nodes)
-        points = (x or randn(nrows)).astype(dtype)
-        points += (y or 1j * randn(nrows)).astype(dtype)
+    Call frames() to evolve layouts for many random seeds at once.
 
-        yield points.real.copy(), points.imag.copy()
+    Call frame(steps, start=old_frame) to update an old layout when nodes
+    or links are added. Old nodes keep their positions, new nodes start
+    near their neighbours, and a few low-heat steps relax the layout.
+    >>> frame = graph.frame(20, start="ready/graphs/brundle.csv")
+    """
 
-        matrix -= diags(matrix.diagonal())
-        matrix *= nrows / matrix.sum()
-        matrix = laplacian(matrix, use_out_degree=True)
-        matrix += identity(nrows, dtype=matrix.dtype, format=matrix.format)
+    def __init__(self, graph):
+        if isinstance(graph, type(self)):
+            self.links, self._matrix = graph.links, graph.matrix
+        else:
+            self._matrix, nodes = linked(graph)
+            self.links = tabled(self._matrix, nodes)
+
+    def __call__(self, nsteps, x=(), y=(), seed=None, start=None, **kwargs):
+        """ Iterator[tuple]: (x, y) after each step. Returns (steps, residual). """
+        nrows = len(self.nodes)
 
-        for speed in linspace(1, 0.1, nsteps - 1):
-            forces = (z - points for z in points)
-            forces = (z / (z * z.conj()).real.clip(1e-9, None) for z in forces)
-            forces = fromiter((z.mean() for z in forces), count=nrows, dtype=dtype)
-            forces -= matrix.dot(points)
-            points += limited(forces, speed)
+        dtype = "complex128"
+        rand = randn if (seed is None) else RandomState(seed).randn
+        if start is not None:
+            points = self.placed(start, seed)
+            kwargs.setdefault("heat", WARM)
+        else:
+            points = (x or rand(nrows)).astype(dtype)
+            points += (y or 1j * rand(nrows)).astype(dtype)
 
-            yield points.real.copy(), points.imag.copy()
+        return (yield from self.evolve(points, nsteps, **kwargs))
 
     def __iter__(self):
         return self.links.itertuples(index=False, name="Link")
@@ -77,31 +293,240 @@ class Graph:
     def __repr__(self):
         return f"{type(self).__name__} with {len(self)} links\n{self.links}"
 
-    def frame(self, steps=120):
-        """ DataFrame: [node|x,y] after n steps of evolution. """
+    def evolve(
+        self,
+        points,
+        nsteps,
+        force="exact",
+        workers=1,
+        heat=1.0,
+        adaptive=False,
+        jitter=JITTER,
+        tol=0,
+        **kwargs,
+    ):
+        """
+        Iterator[tuple]: (x, y) after each step from (n,) or (k, n) points.
+        Returns (number of steps, RMS residual force) when finished.
+        Stops early if RMS node movement in one step falls below tol.
+        Set adaptive=True for ForceAtlas2 swing/traction speeds per node.
+        Lower heat takes smaller steps, e.g. to relax a warm start.
+        """
+        matrix = self.springs
+
+        force = FORCES.get(force, force)
+        mass = 1 + self.matrix.getnnz(axis=1)
+        points = points.copy()
+        nrows = points.shape[-1]
+
+        yield points.real.copy(), points.imag.copy()
+
+        blocks = [x for x in array_split(arange(nrows), workers) if len(x)]
+        matrices = [matrix[x] for x in blocks]
+        glide, prior, residual, nstep = heat, zeros_like(points), nan, 0
+        with ThreadPoolExecutor(workers) as pool:
+            for nstep, speed in enumerate(heat * linspace(1, 0.1, nsteps - 1), 1):
+                repel = force(points, **kwargs)
+                jobs = zip(blocks, matrices)
+                jobs = [pool.submit(netforce, repel, m, points, x) for x, m in jobs]
+                forces = concatenate([job.result() for job in jobs], axis=-1)
+                if adaptive:
+                    glide, speed = swinging(forces, prior, mass, glide, jitter, heat)
+                    prior = forces
+                moves = limited(forces, speed)
+                points += moves
+
+                yield points.real.copy(), points.imag.copy()
+
+                residual = rms(forces).max()
+                if rms(moves).max() < tol:
+                    break
+
+        return nstep, residual
+
+    def frame(self, steps=120, **kwargs):
+        """
+        DataFrame: [node|x,y] after n steps of evolution.
+        Set start=previous_frame to warm-start from an older layout.
+        Steps used and residual force are saved in DataFrame.attrs.
+        """
         nodes = self.nodes
-        for x, y in self(steps):
-            pass
+        (x, y), (nstep, residual) = exhausted(self(steps, **kwargs))
 
-        return DataFrame({"x": x, "y": y}, index=nodes)
+        frame = DataFrame({"x": x, "y": y}, index=nodes)
+        frame.attrs.update(steps=nstep, residual=residual)
 
-    @property
-    def matrix(self):
-        """ scipy.sparse.coo: Links as a sparse matrix. """
-        links, nodes = self.links, self.nodes
+        return frame
+
+    def frames(self, seeds, steps=120, pivots=PIVOTS, **kwargs):
+        """
+        Tuple[DataFrame, Series]: [seed, node|x,y] layouts and stress per seed.
+        Evolves all layouts at once as one stacked (seeds, nodes) array.
+        Each layout matches frame(steps, seed=seed). Lower stress is better.
+        >>> layouts, scores = graph.frames(range(8), 90)
+        >>> best = layouts.loc[scores.idxmin()]
+        """
+        nodes, stresses = self.nodes, self.stresses
+
+        seeds = list(seeds)
+        points = stack([RandomState(x).randn(2, len(nodes)) for x in seeds])
+        points = points[:, 0] + 1j * points[:, 1]
+        (x, y), (nstep, residual) = exhausted(self.evolve(points, steps, **kwargs))
+
+        index = MultiIndex.from_product([seeds, nodes])
+        layouts = DataFrame({"x": x.ravel(), "y": y.ravel()}, index=index)
+        layouts.attrs.update(steps=nstep, residual=residual)
+        scores = Series(stresses(x + 1j * y, pivots), index=seeds, name="stress")
+
+        return layouts, scores
+
+    def placed(self, frame, seed=None):
+        """
+        ndarray: Complex node positions copied from a previous frame.
+        Accepts a DataFrame or CSV path with [node|x,y] columns.
+        Each new node goes to the mean of its placed neighbours, plus a nudge.
+        Nodes with no path to a placed node start at random positions.
+        """
+        matrix, nodes = self.matrix, self.nodes
+
+        rand = randn if (seed is None) else RandomState(seed).randn
+        frame = frame if isinstance(frame, DataFrame) else read_csv(frame, index_col=0)
+        frame = frame.reindex(nodes)
+        points = (frame["x"] + 1j * frame["y"]).values.astype("complex128")
 
-        i = links["source"].cat.codes.values
-        j = links["target"].cat.codes.values
-        k = links["weight"].values
-        n = len(nodes)
+        matrix = ((matrix + matrix.T) != 0).astype(float)
+        known = isfinite(points)
+        while not known.all():
+            counts = matrix.dot(known.astype(float))
+            sums = matrix.dot(where(known, points, 0))
+            new = ~known & (counts > 0)
+            if not new.any():
+                break
 
-        return coo_matrix((k, (i, j)), shape=(n, n)).tocsr()
+            nudge = NUDGE * (rand(new.sum()) + 1j * rand(new.sum()))
+            points[new] = sums[new] / counts[new] + nudge
+            known |= new
+
+        points[~known] = rand((~known).sum()) + 1j * rand((~known).sum())
+
+        return points
+
+    def stresses(self, points, pivots=PIVOTS):
+        """
+        ndarray: Normalized stress of each (k, n) layout. Lower is better.
+        Compares distances from some pivot nodes to their graph distances.
+        Each layout is rescaled to minimize its stress before comparing.
+        """
+        matrix, nrows = self.matrix, len(self.nodes)
+
+        pivots = unique(linspace(0, nrows - 1, min(nrows, pivots)).astype(int))
+        hops = shortest_path(matrix, directed=False, unweighted=True, indices=pivots)
+        valid = isfinite(hops) & (hops > 0)
+        hops = hops[valid]
+        weights = 1 / (hops * hops)
+
+        stresses = []
+        for z in points.reshape(-1, nrows):
+            dist = abs(z[pivots, None] - z[None, :])[valid]
+            scale = (weights * dist * hops).sum() / (weights * dist * dist).sum()
+            stresses.append((weights * (scale * dist - hops) ** 2).mean())
+
+        return array(stresses)
+
+    # Shortest paths
+
+    def degrees(self, *cores, directed=True):
+        """
+        Series: Fewest links from any core node to each node. -1 if no path.
+        >>> graph.degrees("Martin Brundle")
+        """
+        matrix, nodes = self.matrix, self.nodes
+
+        kw = dict(directed=directed, unweighted=True, min_only=True)
+        hops = dijkstra(matrix, indices=self.indexed(cores), **kw)
+
+        return Series(hopped(hops), index=nodes)
+
+    def diameter(self, directed=True):
+        """ int: Most links in any shortest path between two nodes. """
+        return int(self.eccentricity(directed=directed).max())
+
+    def distances(self, *sources, directed=True):
+        """ DataFrame: [node|source] fewest links from each source. -1 if no path. """
+        matrix, nodes = self.matrix, self.nodes
+
+        kw = dict(directed=directed, unweighted=True)
+        hops = shortest_path(matrix, indices=self.indexed(sources), **kw)
+
+        return DataFrame(hopped(hops).T, index=nodes, columns=list(sources))
+
+    def eccentricity(self, directed=True):
+        """ Series: Most links from each node to any node it can reach. """
+        hopchunks, nodes = self.hopchunks, self.nodes
+
+        hops = (x.max(axis=1) for x in hopchunks(directed=directed))
+
+        return Series(concatenate(list(hops)), index=nodes)
+
+    def histogram(self, directed=True):
+        """ Series: Number of (source, target) pairs at each distance > 0. """
+        hopchunks, nrows = self.hopchunks, len(self.nodes)
+
+        counts = zeros(nrows, dtype=int64)
+        for hops in hopchunks(directed=directed):
+            counts += bincount(hops[hops > 0], minlength=nrows)
+
+        counts = trim_zeros(counts, "b")[1:]
+        index = Index(arange(1, 1 + len(counts)), name="hops")
+
+        return Series(counts, index=index, name="pairs")
+
+    def hopchunks(self, directed=True, chunksize=CHUNKSIZE):
+        """ Iterator[ndarray]: (sources, nodes) hops from every node, in chunks. """
+        matrix, nrows = self.matrix, len(self.nodes)
+
+        step = max(1, chunksize // max(1, nrows))
+        kw = dict(directed=directed, unweighted=True)
+        for i in range(0, nrows, step):
+            rows = arange(i, min(i + step, nrows))
+            yield hopped(shortest_path(matrix, indices=rows, **kw))
+
+    def indexed(self, names):
+        """ ndarray: Integer position of each node name. Raise KeyError if missing. """
+        nodes = self.nodes
+
+        names = list(names)
+        rows = nodes.get_indexer(names)
+        if (rows < 0).any():
+            raise KeyError([x for x, i in zip(names, rows) if i < 0])
+
+        return rows
+
+    # Properties
+
+    @property
+    def matrix(self):
+        """ scipy.sparse.csr: Links as a sparse matrix. Shared; do not modify. """
+        return self._matrix
 
     @property
     def nodes(self):
         """ Index: Sorted union of sources and targets. """
         return self.links["source"].cat.categories
 
+    @property
+    def springs(self):
+        """ scipy.sparse.csr: Normalized Laplacian plus identity for attraction. """
+        matrix = self.matrix
+
+        nrows = matrix.shape[0]
+        matrix = matrix - diags(matrix.diagonal())
+        matrix = matrix * (nrows / matrix.sum())
+        matrix = laplacian(matrix, use_out_degree=True)
+        matrix += identity(nrows, dtype=matrix.dtype, format=matrix.format)
+
+        return matrix
+
 
 # Copyright © 2020 Sam Kennerly
 #
@@ -6,7 +6,7 @@ from pathlib import Path
 from numpy import random
 from pandas import DataFrame, Series
 
-from ergast_api import ErgastAPI
+from ergast_api import AsyncErgastAPI, ErgastAPI
 from ergast_zip import ErgastZIP
 from graph import Graph
 from plot import Plot
@@ -15,6 +15,7 @@ from plot import Plot
 REPO = Path(__file__).resolve().parent.parent
 DATADIR = REPO / "data"
 ERGAST_API = DATADIR / "cache"
+ERGAST_ARROW = DATADIR / "arrow"
 ERGAST_ZIP = DATADIR / "ergast/f1.zip"
 TABLEDIR = DATADIR / "tables"
 PLOTDIR = DATADIR / "plots"
@@ -1,22 +1,158 @@
+from collections import OrderedDict, deque
 from collections.abc import Mapping
-from json import load as jsonload
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from gzip import GzipFile
+from hashlib import blake2b
+from html import escape
+from html.parser import HTMLParser
+from io import BytesIO
+from json import dump as jsondump, dumps as jsondumps, load as jsonload
+from json import loads as jsonloads
+from os import replace
 from os.path import relpath
 from pathlib import Path
 from posixpath import join as posixjoin
+from re import DOTALL, split, sub
 from subprocess import run
 from urllib.parse import quote, urlsplit
 
 try:
-    from mistune import Markdown
+    from brotli import compress as brcompress
+except ImportError:
+    brcompress = None
+
+try:
+    from mistune import Markdown, __version__ as mdversion
 
     mdparse = Markdown().parse
 except ImportError as err:
+    mdversion = None
 
     def mdparse(text, err=err):
         """ None: Show error caused by trying to import Markdown parser. """
         raise ImportError(f"Cannot parse Markdown: {err}")
 
 
+class Fragment(HTMLParser):
+    """
+    Pure Python stand-in for HTML Tidy. Feed it a page or fragment,
+    then call it for indented lines of the <body> contents.
+    Comments are kept, <head> is dropped, and text in RAWS is untouched.
+    """
+
+    BLOCKS = frozenset(
+        "address article aside blockquote body dd details dialog div dl dt "
+        "fieldset figcaption figure footer form h1 h2 h3 h4 h5 h6 header hr "
+        "li main nav ol p pre section summary table tbody td tfoot th thead "
+        "tr ul".split()
+    )
+    RAWS = frozenset("pre script style textarea".split())
+    VOIDS = frozenset(
+        "area base br col embed hr img input link meta source track wbr".split()
+    )
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.root = ("", (), [])
+        self.stack = [self.root]
+
+    def __call__(self):
+        """ Iterator[str]: Indented lines of <body> contents. """
+        nodes = self.root[2]
+        for tag in ("html", "body"):
+            found = [x for x in nodes if isinstance(x, tuple) and (x[0] == tag)]
+            nodes = found[0][2] if found else nodes
+        nodes = [x for x in nodes if not (isinstance(x, tuple) and (x[0] == "head"))]
+
+        return self.lines(nodes, 0)
+
+    # Parser callbacks
+
+    def handle_comment(self, data):
+        self.stack[-1][2].append(f"<!--{data}-->")
+
+    def handle_data(self, data):
+        node = self.stack[-1]
+        raw = node[0] in ("script", "style")
+        node[2].append(data if raw else escape(data, quote=False))
+
+    def handle_endtag(self, tag):
+        stack = self.stack
+        if tag in ("body", "html"):
+            return
+        if any(x[0] == tag for x in stack[1:]):
+            while stack.pop()[0] != tag:
+                pass
+
+    def handle_startendtag(self, tag, attrs):
+        self.stack[-1][2].append((tag, tuple(attrs), []))
+
+    def handle_starttag(self, tag, attrs):
+        node = (tag, tuple(attrs), [])
+        self.stack[-1][2].append(node)
+        if tag not in self.VOIDS:
+            self.stack.append(node)
+
+    # Serializers
+
+    def inline(self, node, pre=False):
+        """ str: Node as HTML on one line. Whitespace collapses unless in RAWS. """
+        if not isinstance(node, tuple):
+            return node
+
+        tag, attrs, children = node
+        start, end = self.tags(node)
+        pre = pre or (tag in self.RAWS)
+        inner = "".join(self.inline(x, pre) for x in children)
+
+        return start + (inner if pre else sub(r"\s+", " ", inner)) + end
+
+    def isblock(self, node):
+        """ bool: True if node goes on its own line. """
+        tag = node[0] if isinstance(node, tuple) else None
+
+        return (tag in self.BLOCKS) or (tag in self.RAWS)
+
+    def lines(self, nodes, depth):
+        """ Iterator[str]: Block nodes on their own lines, indented by depth. """
+        inline, isblock, tags = self.inline, self.isblock, self.tags
+        pad = "  " * depth
+
+        run = []
+        for node in (*nodes, None):
+            if not ((node is None) or isblock(node)):
+                run.append(inline(node))
+                continue
+
+            text = sub(r"\s+", " ", "".join(run)).strip()
+            if text:
+                yield pad + text
+            run = []
+
+            if node is None:
+                break
+            elif node[0] in self.RAWS:
+                yield pad + inline(node)
+            elif any(map(isblock, node[2])):
+                start, end = tags(node)
+                yield pad + start
+                yield from self.lines(node[2], depth + 1)
+                yield pad + end
+            else:
+                start, end = tags(node)
+                inner = "".join(map(inline, node[2]))
+                yield pad + start + sub(r"\s+", " ", inner).strip() + end
+
+    def tags(self, node):
+        """ tuple: Start and end tags. End tag is empty for void elements. """
+        tag, attrs, _ = node
+        attrs = "".join(
+            f" {k}" if (v is None) else f' {k}="{escape(v)}"' for k, v in attrs
+        )
+
+        return f"<{tag}{attrs}>", ("" if (tag in self.VOIDS) else f"</{tag}>")
+
+
 class Quire(Mapping):
     """
     Generate web pages from HTML fragments and/or Markdown files.
@@ -37,14 +173,29 @@ class Quire(Mapping):
     Call help(Quire) for more information.
     """
 
+    ASSETS = ".assets.json"
+    BACKLOG = 2
+    CHUNKSIZE = 16
+    MANIFEST = ".quire.json"
     OPTIONS = "index.json"
     PAGES = "pages.txt"
+    RENDERS = 4096
+    TEMPLATES = 64
+    TEXTS = (".css", ".html", ".js", ".json", ".svg", ".txt", ".xml")
+    TIDIED = ".tidy.json"
 
-    def __init__(self, folder="."):
+    def __init__(self, folder=".", cache=None):
         self.folder = Path(folder).resolve()
+        self.cache = Path(cache).resolve() if cache else None
+        self._assets = {}
         self._home = None
+        self._navs = OrderedDict()
         self._options = None
         self._pages = None
+        self._positions = None
+        self._prefixes = {}
+        self._renders = None
+        self._tree = None
 
     # Magic methods
 
@@ -70,7 +221,9 @@ class Quire(Mapping):
 
     def __repr__(self):
         """ str: Printable representation of self. """
-        return f"{type(self).__name__}({self.folder})"
+        cache = f", cache={self.cache}" if self.cache else ""
+
+        return f"{type(self).__name__}({self.folder}{cache})"
 
     def __truediv__(self, pathlike):
         """ Path: Absolute path. If input is relative, then append to base """
@@ -80,33 +233,128 @@ class Quire(Mapping):
 
     @classmethod
     def apply(cls, style, sheet):
-        """ None: Cat CSS files from style folder and write to one file. """
-        stylecat, write = cls.stylecat, cls.write
+        """ None: Cat CSS files from style folder, minify, and write to one file. """
+        minify, stylecat, write = cls.minify, cls.stylecat, cls.write
 
-        style = "".join(map(str.strip, stylecat(style)))
+        style = minify("".join(stylecat(style)))
         print("Write", sheet)
         write(style, sheet)
 
-    def build(self, target):
-        """ None: Generate each page and write to target folder. """
-        items, validpath, write = self.items, self.validpath, self.write
+    def build(self, target, workers=1, incremental=False, assets=False):
+        """
+        None: Generate each page and write to target folder.
+        If incremental, then skip pages whose inputs have not changed
+        and only write pages whose bytes have changed.
+        If assets, then link to fingerprinted copies of styles and icons.
+        """
+        generated, validpath, write = self.generated, self.validpath, self.write
 
         target = validpath(target)
-        for path, text in items():
+        saved = target / self.MANIFEST
+
+        self._assets = self.fingerprint(target) if assets else {}
+
+        pages = self.pages
+        if incremental:
+            manifest, old = self.manifest, {}
+            if saved.is_file():
+                with open(saved) as file:
+                    old = jsonload(file)
+            if old.get("site") == manifest["site"]:
+                new, old = manifest["pages"], old.get("pages", {})
+                keys = (x.relative_to(self).as_posix() for x in pages)
+                pages = [
+                    page
+                    for page, key in zip(pages, keys)
+                    if (old.get(key) != new[key])
+                    or not (target / key).with_suffix(".html").is_file()
+                ]
+            print("Skip", len(self) - len(pages), "unchanged pages")
+
+        for path, text in generated(workers, pages):
             path = target / path.relative_to(self).with_suffix(".html")
+            if incremental and path.is_file() and (path.read_text() == text):
+                continue
             print("Write", path)
             write(text, path)
 
+        if incremental:
+            write(jsondumps(manifest, indent=2, sort_keys=True), saved)
+        if self.cache:
+            self.persist()
+
     @classmethod
-    def clean(cls, source, target):
-        """ None: Save clean page <body> contents to target folder. """
-        tidybody, validpath = cls.tidybody, cls.validpath
+    def clean(cls, source, target, workers=1, backend="tidy"):
+        """
+        None: Save clean page <body> contents to target folder.
+        Runs up to workers cleaners at once. Backend "tidy" runs HTML Tidy
+        and backend "python" uses a pure Python Fragment parser instead.
+        Skips pages whose clean output is unchanged since the last run.
+        """
+        digest, validpath = cls.digest, cls.validpath
+        tidy = {"python": cls.normalbody, "tidy": cls.tidybody}[backend]
 
         source, target = validpath(source), validpath(target)
+        saved = target / cls.TIDIED
+
+        old = {}
+        if saved.is_file():
+            with open(saved) as file:
+                old = jsonload(file)
+        old = old.get("pages", {}) if (old.get("backend") == backend) else {}
+
+        tidied, todo = {}, []
         for dirty in source.rglob("*.html"):
             clean = target / dirty.relative_to(source)
-            print("Tidy", clean)
-            tidybody(dirty, clean)
+            key, hashed = clean.relative_to(target).as_posix(), digest(dirty)
+            before, after = old.get(key, ("", ""))
+            if (hashed in (before, after)) and clean.is_file():
+                if digest(clean) == after:
+                    tidied[key] = (before, after)
+                    continue
+            todo.append((dirty, clean, key, hashed))
+        print("Skip", len(tidied), "clean pages")
+
+        with ThreadPoolExecutor(max(1, workers)) as pool:
+            tasks = {pool.submit(tidy, x[0], x[1]): x for x in todo}
+            try:
+                for task in as_completed(tasks):
+                    task.result()
+                    _, clean, key, hashed = tasks[task]
+                    print("Tidy", clean)
+                    tidied[key] = (hashed, digest(clean))
+            finally:
+                tidied = {"backend": backend, "pages": tidied}
+                cls.write(jsondumps(tidied, indent=2, sort_keys=True), saved)
+
+    @classmethod
+    def compress(cls, target):
+        """
+        None: Save .gz copies of text files in target folder.
+        Also saves .br copies if brotli is installed, and says so if not.
+        Skips copies which are newer than their source files.
+        """
+        texts, validpath = cls.TEXTS, cls.validpath
+
+        squash = {".gz": cls.gzipped}
+        if brcompress:
+            squash[".br"] = brcompress
+        else:
+            print("Skip .br copies because brotli is not installed")
+
+        target = validpath(target)
+        for path in sorted(target.rglob("*")):
+            if path.name.startswith(".") or (path.suffix not in texts):
+                continue
+
+            data, mtime = None, path.stat().st_mtime
+            for suffix, method in squash.items():
+                packed = path.with_name(path.name + suffix)
+                if packed.is_file() and (packed.stat().st_mtime >= mtime):
+                    continue
+                data = path.read_bytes() if (data is None) else data
+                print("Compress", packed)
+                packed.write_bytes(method(data))
 
     @classmethod
     def delete(cls, suffix, target):
@@ -120,6 +368,11 @@ class Quire(Mapping):
 
     # Page generator
 
+    @classmethod
+    def adopt(cls, quire):
+        """ None: Keep a Quire for this worker process to render pages. """
+        cls._worker = quire
+
     def generate(self, page, language="", title="", **kwargs):
         """ Iterator[str]: All lines in page. """
 
@@ -131,7 +384,7 @@ class Quire(Mapping):
         yield from self.nav(page, **kwargs)
         yield "<main>"
         if page.suffix == ".md":
-            yield mdparse("".join(self.readlines(page)))
+            yield self.cached("md", "".join(self.readlines(page)), mdparse)
         else:
             yield from map(str.rstrip, self.readlines(page))
         yield "</main>"
@@ -140,6 +393,39 @@ class Quire(Mapping):
         yield from self.klf(page, **kwargs)
         yield "</body>\n</html>\n"
 
+    def generated(self, workers=1, pages=None):
+        """
+        Iterator[tuple]: Page paths and generated pages in order.
+        Use workers > 1 to generate pages in a pool of processes.
+        At most BACKLOG chunks per worker wait in memory to be written.
+        """
+        adopt, render = self.adopt, self.render
+        backlog, chunksize = self.BACKLOG, self.CHUNKSIZE
+
+        pages = self.pages if (pages is None) else tuple(pages)
+        if workers < 2:
+            yield from ((x, self[x]) for x in pages)
+            return
+
+        # Find home and options once, so each worker gets its own copy.
+        self.home, self.options
+        chunks = (pages[i : i + chunksize] for i in range(0, len(pages), chunksize))
+        with ProcessPoolExecutor(workers, initializer=adopt, initargs=(self,)) as pool:
+            queue = deque()
+            for chunk in chunks:
+                queue.append((chunk, pool.submit(render, chunk)))
+                if len(queue) >= backlog * workers:
+                    chunk, texts = queue.popleft()
+                    yield from zip(chunk, texts.result())
+            while queue:
+                chunk, texts = queue.popleft()
+                yield from zip(chunk, texts.result())
+
+    @classmethod
+    def render(cls, pages):
+        """ List[str]: Pages generated by this worker process's Quire. """
+        return [cls._worker[x] for x in pages]
+
     # Home page
 
     @property
@@ -168,11 +454,11 @@ class Quire(Mapping):
         Links can be JPEGs, PNGs, ICOs or even GIFs.
         Consider SVG so there's no scaling glitch. (I love it.)
         """
-        folder, urlpath = self.folder, self.urlpath
+        asset, folder, urlpath = self.asset, self.folder, self.urlpath
 
         yield '<section id="icons">'
         for alt, src, href in icons:
-            src = urlpath(page, folder / src)
+            src = urlpath(page, folder / asset(src))
             alt = f'<img alt="{alt}" src="{src}" height="32" title="{alt}">'
             yield f'<a href="{href}">{alt}</a>'
         yield "</section>"
@@ -185,7 +471,7 @@ class Quire(Mapping):
         """
         path, pages, urlpath = self / page, self.pages, self.urlpath
 
-        i, n = pages.index(path), len(pages)
+        i, n = self.positions[path], len(pages)
         urlprev = urlpath(path, pages[(i - 1) % n].with_suffix(".html"))
         urlnext = urlpath(path, pages[(i + 1) % n].with_suffix(".html"))
 
@@ -223,7 +509,7 @@ class Quire(Mapping):
 
     def links(self, page, base="", favicon="", styles=(), **kwargs):
         """ Iterator[str]: <link> tags in page <head>. """
-        folder, home, urlpath = self.folder, self.home, self.urlpath
+        asset, folder, home, urlpath = self.asset, self.folder, self.home, self.urlpath
 
         link = '<link rel="{}" href="{}">'.format
         page = (folder / page).with_suffix(".html")
@@ -231,9 +517,9 @@ class Quire(Mapping):
         if base:
             yield link("canonical", posixjoin(base, urlpath(home, page)))
         if favicon:
-            yield link("icon", urlpath(page, folder / favicon))
+            yield link("icon", urlpath(page, folder / asset(favicon)))
         for sheet in styles:
-            yield link("stylesheet", urlpath(page, folder / sheet))
+            yield link("stylesheet", urlpath(page, folder / asset(sheet)))
 
     def meta(self, page, author="", description="", generator="", meta=(), **kwargs):
         """ Iterator[str]: <meta> tags in page <head>. """
@@ -251,36 +537,295 @@ class Quire(Mapping):
 
     def nav(self, page, homelink="home", **kwargs):
         """ Iterator[str]: <nav> element with links to other pages in site. """
-        home, pages, urlpath = self.home, self.pages, self.urlpath
+        home, template = self.home, self.template
 
-        opendirs = frozenset(page.parents)
-        workdirs = frozenset(home.parents)
+        text, spans = template(page.parent, homelink)
+        if page == home:
+            this = f'<a href="#" rel="home">{homelink}</a>'
+        else:
+            this = f'<a href="#">{page.stem.replace("_", " ")}</a>'
 
-        yield "<nav>"
-        for p in pages:
+        parts, end = [], 0
+        for start, stop in spans.get(page, ()):
+            parts += [text[end:start], this]
+            end = stop
+        parts.append(text[end:])
 
-            context = workdirs
-            workdirs = frozenset(p.parents)
-            yield from ("</details>" for _ in (context - workdirs))
-            for d in sorted(workdirs - context):
-                name = d.stem.replace("_", " ")
-                if d in opendirs:
-                    yield f"<details open><summary>{name}</summary>"
-                else:
-                    yield f"<details><summary>{name}</summary>"
+        yield "".join(parts)
+
+    # Site index
+
+    @property
+    def positions(self):
+        """ dict: Position of each page in site. """
+        positions = self._positions
+
+        if positions is None:
+            positions = {}
+            for i, page in enumerate(self.pages):
+                positions.setdefault(page, i)
+            self._positions = positions
+
+        return positions
+
+    def prefix(self, folder, start):
+        """ str: Quoted URL prefix from start folder to another folder. """
+        key, prefixes = (folder, start), self._prefixes
+
+        if key not in prefixes:
+            prefix = relpath(posixjoin(folder), start=start.as_posix())
+            prefixes[key] = "" if (prefix == ".") else (quote(prefix) + "/")
+
+        return prefixes[key]
+
+    def reindex(self):
+        """
+        None: Forget home page, options, page list and site index.
+        Call after pages are added, removed or reordered, or after
+        index.json changes. Keeps the render cache.
+        """
+        self._navs.clear()
+        self._home = self._options = self._pages = None
+        self._positions = self._tree = None
+
+    def template(self, folder, homelink="home"):
+        """
+        tuple: <nav> text as seen from pages in folder, and a dict of
+        (start, stop) spans of each page's own link. Only the current
+        page link differs between pages in the same folder, so one
+        template serves them all. Keeps the last TEMPLATES templates.
+        """
+        key, navs = (folder, homelink), self._navs
+
+        if key in navs:
+            navs.move_to_end(key)
+            return navs[key]
+
+        home, pages, prefix, tree = self.home, self.pages, self.prefix, self.tree
+        opendirs = frozenset((folder, *folder.parents))
 
-            name = p.stem.replace("_", " ")
-            href = "#" if (p == page) else urlpath(page, p.with_suffix(".html"))
-            if p == home:
-                yield f'<a href="{href}" rel="home">{homelink}</a>'
+        lines, spans, size = ["<nav>"], {}, len("<nav>") + 1
+        for kind, value in tree:
+            if kind == "open":
+                name = value.stem.replace("_", " ")
+                if value in opendirs:
+                    line = f"<details open><summary>{name}</summary>"
+                else:
+                    line = f"<details><summary>{name}</summary>"
+            elif kind == "close":
+                line = "</details>"
             else:
-                yield f'<a href="{href}">{name}</a>'
+                p = pages[value]
+                href = prefix(p.parent, folder) + quote(p.with_suffix(".html").name)
+                if p == home:
+                    line = f'<a href="{href}" rel="home">{homelink}</a>'
+                else:
+                    line = f'<a href="{href}">{p.stem.replace("_", " ")}</a>'
+                spans.setdefault(p, []).append((size, size + len(line)))
+            lines.append(line)
+            size += len(line) + 1
+        lines.append("</nav>")
+
+        navs[key] = ("\n".join(lines), spans)
+        while len(navs) > self.TEMPLATES:
+            navs.popitem(last=False)
+
+        return navs[key]
+
+    @property
+    def tree(self):
+        """
+        Tuple[tuple]: Folder tree as ("open", folder), ("close", None)
+        and ("page", position) steps in the same order as <nav> tags.
+        """
+        tree = self._tree
+
+        if tree is None:
+            home, pages = self.home, self.pages
+
+            tree, workdirs = [], frozenset(home.parents)
+            for i, p in enumerate(pages):
+                context = workdirs
+                workdirs = frozenset(p.parents)
+                tree += [("close", None) for _ in (context - workdirs)]
+                tree += [("open", d) for d in sorted(workdirs - context)]
+                tree.append(("page", i))
+            tree += [("close", None) for _ in (workdirs - set(home.parents))]
+
+            tree = tuple(tree)
+            self._tree = tree
+
+        return tree
+
+    # Assets
+
+    def asset(self, name):
+        """ str: Fingerprinted name of a style or icon file, if any. """
+        return self._assets.get(name, name)
+
+    def fingerprint(self, target):
+        """
+        dict: Copy styles, favicon and icons in target folder to names
+        with a hash of their contents, e.g. style.3f9a2c1d.css.
+        Browsers can cache those copies forever. Saves the names to ASSETS
+        and deletes copies (and their .gz and .br copies) no longer listed.
+        """
+        options, query, write = self.options, self.query, self.write
+        saved = Path(target) / self.ASSETS
+
+        names = set()
+        for page in self.pages:
+            kwargs = query(page, **options)
+            names.update(kwargs.get("styles", ()))
+            names.update(src for _, src, _ in kwargs.get("icons", ()))
+            names.add(kwargs.get("favicon", ""))
+
+        assets = {}
+        for name in sorted(names):
+            path = Path(target) / name
+            if (not name) or urlsplit(name).scheme or not path.is_file():
+                continue
+
+            data = path.read_bytes()
+            hashed = blake2b(data, digest_size=4).hexdigest()
+            hashed = path.with_name(f"{path.stem}.{hashed}{path.suffix}")
+            if not hashed.is_file():
+                print("Write", hashed)
+                hashed.write_bytes(data)
+            assets[name] = hashed.relative_to(target).as_posix()
+
+        old = {}
+        if saved.is_file():
+            with open(saved) as file:
+                old = jsonload(file)
+        for stale in set(old.values()) - set(assets.values()):
+            for suffix in ("", ".gz", ".br"):
+                path = Path(target) / f"{stale}{suffix}"
+                if path.is_file():
+                    print("Delete", path)
+                    path.unlink()
+
+        write(jsondumps(assets, indent=2, sort_keys=True), saved)
+
+        return assets
+
+    # Render cache
+
+    def cached(self, kind, data, parse):
+        """
+        object: parse(data), memoized by kind and a hash of data.
+        Keeps the last RENDERS results. Results must not be modified.
+        """
+        renders = self.renders
+
+        raw = data.encode() if isinstance(data, str) else data
+        key = f"{kind}:{blake2b(raw, digest_size=16).hexdigest()}"
+        if key in renders:
+            renders.move_to_end(key)
+            return renders[key]
+
+        value = renders[key] = parse(data)
+        while len(renders) > self.RENDERS:
+            renders.popitem(last=False)
+
+        return value
+
+    def persist(self):
+        """ None: Save render cache to cache file. """
+        cache, renders = self.cache, self.renders
+
+        temp = cache.with_suffix(cache.suffix + ".tmp")
+        temp.parent.mkdir(exist_ok=True, parents=True)
+        with open(temp, "w") as file:
+            print("Save", cache)
+            jsondump({"markdown": mdversion, "renders": list(renders.items())}, file)
+        replace(temp, cache)
+
+    @property
+    def renders(self):
+        """ OrderedDict: Parsed options and Markdown. Loads cache file if any. """
+        renders = self._renders
 
-        yield from ("</details>" for _ in (workdirs - set(home.parents)))
-        yield "</nav>"
+        if renders is None:
+            cache, renders = self.cache, OrderedDict()
+            if cache and cache.is_file():
+                with open(cache) as file:
+                    saved = jsonload(file)
+                if saved.get("markdown") == mdversion:
+                    renders.update(saved["renders"][-self.RENDERS :])
+
+            self._renders = renders
+
+        return renders
 
     # File methods
 
+    @classmethod
+    def digest(cls, *paths):
+        """ str: Hash of file contents. Missing files count as empty. """
+        digest = blake2b(digest_size=16)
+        for path in map(Path, paths):
+            digest.update(path.read_bytes() if path.is_file() else b"")
+            digest.update(b"\0")
+
+        return digest.hexdigest()
+
+    @classmethod
+    def gzipped(cls, data):
+        """ bytes: Gzip data with no timestamp, so equal data gives equal bytes. """
+        buffer = BytesIO()
+        with GzipFile(fileobj=buffer, mode="wb", compresslevel=9, mtime=0) as file:
+            file.write(data)
+
+        return buffer.getvalue()
+
+    @property
+    def manifest(self):
+        """
+        dict: Hashes of build inputs. The site hash covers everything
+        shared by all pages: index.json, pages.txt, the page list,
+        fingerprinted assets, and this file.
+        Page hashes cover each page and its JSON file.
+        """
+        digest, folder, pages = self.digest, self.folder, self.pages
+
+        site = digest(__file__, folder / self.OPTIONS, folder / self.PAGES)
+        site += jsondumps(self._assets, sort_keys=True)
+        site += "\n".join(x.relative_to(folder).as_posix() for x in pages)
+        site = blake2b(site.encode(), digest_size=16).hexdigest()
+
+        pages = {
+            x.relative_to(folder).as_posix(): digest(x, x.with_suffix(".json"))
+            for x in pages
+        }
+
+        return {"site": site, "pages": pages}
+
+    @classmethod
+    def minify(cls, css):
+        """ str: CSS without comments or unneeded whitespace. Keeps strings. """
+        quoted = r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')"""
+        css = sub(quoted + r"|/\*.*?\*/", lambda x: x[1] or " ", css, flags=DOTALL)
+        parts = split(quoted, css)
+
+        for i, part in enumerate(parts[::2]):
+            part = sub(r"\s+", " ", part)
+            part = sub(r" ?([{};,>]) ?", r"\1", part)
+            parts[2 * i] = part.replace(": ", ":").replace(";}", "}")
+
+        return "".join(parts).strip()
+
+    @classmethod
+    def normalbody(cls, dirty, clean):
+        """ None: Clean raw HTML page and save. Pure Python, no HTML Tidy. """
+        dirty, clean = Path(dirty), Path(clean)
+
+        fragment = Fragment()
+        fragment.feed(dirty.read_text())
+        fragment.close()
+
+        cls.write("\n".join(fragment()) + "\n", clean)
+
     @property
     def options(self):
         """ dict: Home page options from JSON file. """
@@ -313,13 +858,11 @@ class Quire(Mapping):
 
         return pages
 
-    @classmethod
-    def query(cls, page, **kwargs):
+    def query(self, page, **kwargs):
         """ dict: Page options, if any. Kwargs are default values. """
         path = Path(page).with_suffix(".json")
         if path.is_file():
-            with open(path) as file:
-                kwargs.update(jsonload(file))
+            kwargs.update(self.cached("json", path.read_bytes(), jsonloads))
 
         return kwargs
 